@@ -0,0 +1,290 @@
+import gzip
+import json
+import uuid
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import threading
+from itertools import islice
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from loader import company_key_from_url
+from projection import Projection, projected_page_infos
+from writer import COMPRESSIONS, OUTPUT_FORMATS, open_writer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    digest TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS responses (
+    response_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    language_id TEXT,
+    url TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    last_mod TEXT,
+    url_response TEXT,
+    status INTEGER,
+    date TEXT NOT NULL,
+    headers TEXT,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_url ON responses (url, page);
+"""
+
+
+class ResponseArchive:
+    """Raw response bodies of a harvest (WARC like, content addressed).
+
+    Bodies are stored once per SHA-256 digest as gzip members in append
+    only segment files (`segment-<session>-<nr>.gz`, rotated at
+    `max_segment_size`). The index `archive.sqlite` lists the payloads
+    (digest -> segment, offset, length) and one record per response
+    (language, url, page, sitemap last_mod, response url, status, fetch
+    date, headers, digest). Several processes can write to one archive.
+    """
+
+    def __init__(self, path, max_segment_size=2**30):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_segment_size = max_segment_size
+        self.connection = sqlite3.connect(
+            str(self.path / "archive.sqlite"), timeout=60, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._session = uuid.uuid4().hex[:8]
+        self._segment_nr = -1
+        self._file = None
+
+    def _next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        self._segment_nr += 1
+        self._segment = f"segment-{self._session}-{self._segment_nr:05d}.gz"
+        self._file = open(self.path / self._segment, "ab")
+
+    def add(self, url_info, response, date):
+        """Archive the response of a page (`url_info` with url, page,
+        last_mod and language_id)."""
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            known = self.connection.execute(
+                "SELECT 1 FROM payloads WHERE digest = ?", (digest,)
+            ).fetchone()
+        record = None
+        if known is None:
+            record = gzip.compress(content, compresslevel=6, mtime=0)
+        with self._lock, self.connection:
+            if record is not None:
+                if self._file is None or self._file.tell() >= self.max_segment_size:
+                    self._next_segment()
+                offset = self._file.tell()
+                self._file.write(record)
+                self._file.flush()
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO payloads VALUES (?, ?, ?, ?, ?)",
+                    (digest, self._segment, offset, len(record), len(content)),
+                )
+            self.connection.execute(
+                "INSERT INTO responses (language_id, url, page, last_mod, "
+                "url_response, status, date, headers, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url_info.get("language_id"),
+                    url_info["url"],
+                    url_info["page"],
+                    url_info.get("last_mod"),
+                    response.url,
+                    response.status_code,
+                    date,
+                    json.dumps(dict(response.headers)),
+                    digest,
+                ),
+            )
+
+    def responses(self, language_id=None):
+        """Response records (without body) in archive order. The payload
+        location is included (`segment`, `offset`, `length`)."""
+        sql = (
+            "SELECT language_id, url, page, last_mod, url_response, status, "
+            "date, headers, digest, segment, offset, length "
+            "FROM responses JOIN payloads USING (digest)"
+        )
+        params = ()
+        if language_id is not None:
+            sql += " WHERE language_id = ?"
+            params = (language_id,)
+        sql += " ORDER BY response_id"
+        columns = (
+            "language_id", "url", "page", "last_mod", "url_response", "status",
+            "date", "headers", "digest", "segment", "offset", "length",
+        )
+        for row in self.connection.execute(sql, params):
+            record = dict(zip(columns, row))
+            record["headers"] = json.loads(record["headers"])
+            yield record
+
+    def language_ids(self):
+        rows = self.connection.execute(
+            "SELECT DISTINCT language_id FROM responses ORDER BY language_id"
+        )
+        return [language_id for (language_id,) in rows]
+
+    def payload(self, record):
+        """Body of a response record"""
+        return read_payload(self.path, record["segment"], record["offset"], record["length"])
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.connection.close()
+
+
+def read_payload(path, segment, offset, length):
+    with open(Path(path) / segment, "rb") as f:
+        f.seek(offset)
+        return gzip.decompress(f.read(length))
+
+
+def _parse_payload(task):
+    """Read and parse a payload (runs in the worker processes)"""
+    path, segment, offset, length, projection, page = task
+    content = read_payload(path, segment, offset, length)
+    return projected_page_infos(content, projection, page)
+
+
+def page_data_info(record, page_infos, projection=None):
+    """Page data as stored by a harvest (see
+    `TPCollector._scrape_structured_infos` and `_load_reviews`)"""
+    url = record["url"]
+    headers = record["headers"]
+    if projection is not None:
+        headers = projection.headers(headers)
+    return (
+        dict(
+            url_response=record["url_response"],
+            date=record["date"],
+            headers=headers,
+        )
+        | page_infos
+        | dict(
+            url_base=url,
+            page=record["page"],
+            url_request=url,
+            url_base_last_mod=record["last_mod"],
+            company_key=company_key_from_url(url),
+        )
+    )
+
+
+def replay(
+    archive_path,
+    base_path,
+    language_ids=None,
+    output_format="tar",
+    compression="gzip",
+    extract_reviews=False,
+    n_parse_workers=None,
+    projection=None,
+    batch_size=1000,
+):
+    """Parse the archived responses again (e.g. after the extraction
+    changed) and write them like a harvest
+    (`<date>-<lang>-trustpilot-reviews-jsonld-replay`), optionally with
+    another `projection` (see `projection.Projection`).
+    The payloads are read and parsed in `n_parse_workers` processes.
+    """
+    archive = ResponseArchive(archive_path)
+    base_path = Path(base_path)
+    base_path.mkdir(parents=True, exist_ok=True)
+    today = datetime.datetime.today().strftime("%Y-%m-%d")
+    executor = None
+    if n_parse_workers:
+        executor = ProcessPoolExecutor(max_workers=n_parse_workers)
+    parse_map = map if executor is None else executor.map
+    n_pages = 0
+    try:
+        for language_id in language_ids or archive.language_ids():
+            name = f"{today}-{language_id}-trustpilot-reviews-jsonld-replay"
+            writer = open_writer(
+                base_path,
+                name,
+                output_format=output_format,
+                compression=compression,
+                extract_reviews=extract_reviews,
+            )
+            try:
+                records = archive.responses(language_id)
+                while batch := list(islice(records, batch_size)):
+                    tasks = [
+                        (
+                            archive.path,
+                            r["segment"],
+                            r["offset"],
+                            r["length"],
+                            projection,
+                            r["page"],
+                        )
+                        for r in batch
+                    ]
+                    for record, page_infos in zip(batch, parse_map(_parse_payload, tasks)):
+                        data = page_data_info(record, page_infos, projection)
+                        writer.write(data["company_key"], data["page"], data)
+                        n_pages += 1
+                    print(f"\r{language_id}: {n_pages} pages replayed", end="")
+            finally:
+                writer.close()
+            print()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        archive.close()
+    return n_pages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Parse the raw responses of an archive again (no requests)."
+    )
+    parser.add_argument("archive_path", type=str, help="The response archive (--archive_path of the harvest).")
+    parser.add_argument("data_path", type=str, help="The path to store the parsed data.")
+    parser.add_argument("--language_id", type=str, help="Languages to replay, separated by comma (default: all).", default=None)
+    parser.add_argument("--output_format", type=str, choices=OUTPUT_FORMATS, default="tar")
+    parser.add_argument("--compression", type=str, choices=COMPRESSIONS, default="gzip")
+    parser.add_argument("--extract_reviews", action="store_true", help="Write one deduplicated record per review in addition.")
+    parser.add_argument("--n_parse_workers", type=int, help="Number of parsing processes (default: parse in this process).", default=None)
+    parser.add_argument("--keep_paths", type=str, help="Only store these key paths of __NEXT_DATA__, separated by comma.", default=None)
+    parser.add_argument("--drop_paths", type=str, help="Do not store these key paths of __NEXT_DATA__, separated by comma.", default=None)
+    parser.add_argument("--compact", action="store_true", help="Trim the headers and store company level fields only on the first page of a company.")
+    args = parser.parse_args()
+    projection = None
+    if args.keep_paths or args.drop_paths or args.compact:
+        projection = Projection(
+            keep_paths=args.keep_paths.split(",") if args.keep_paths else None,
+            drop_paths=args.drop_paths.split(",") if args.drop_paths else None,
+            compact=args.compact,
+        )
+    replay(
+        args.archive_path,
+        args.data_path,
+        language_ids=None if args.language_id is None else args.language_id.split(","),
+        output_format=args.output_format,
+        compression=args.compression,
+        extract_reviews=args.extract_reviews,
+        n_parse_workers=args.n_parse_workers,
+        projection=projection,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+import lxml.html
+
+import loader
+import scraper
+from mock_server import MockTrustpilot
+from tp_harvester import TPCollector
+from writer import COMPRESSIONS, OUTPUT_FORMATS, open_writer
+
+
+def offline_collector(mock, path_page_map_infos, calls_per_minute=None, retry_wait=0):
+    """TPCollector harvesting the mock server (rate limit off by default)"""
+    harvester = TPCollector(
+        "http://localhost", "benchmark@localhost", path_page_map_infos
+    )
+    harvester.url_start_page = f"{mock.base_url}/"
+    harvester.url_sitemap_base = mock.base_url
+    harvester.retry_wait = retry_wait
+    harvester.rate_limiter = loader.RateLimiter(calls_per_minute, burst=10)
+    harvester._get_response = loader.get_function_get_response(
+        harvester.session,
+        1,
+        harvester.retry_wait,
+        harvester.timeout,
+        harvester.rate_limiter,
+        harvester.logger,
+        metrics=harvester.metrics,
+        breaker=harvester.circuit_breaker,
+    )
+    harvester.sitemap_rate_limiter = loader.RateLimiter(None)
+    harvester._get_sitemap_response = loader.get_function_get_response(
+        harvester.session,
+        harvester.retry_attempts,
+        harvester.retry_wait,
+        harvester.timeout,
+        harvester.sitemap_rate_limiter,
+        harvester.logger,
+    )
+    return harvester
+
+
+def bench_sitemaps(mock, path):
+    """Sitemap refresh: cold (empty cache) and warm (conditional requests)"""
+    results = {}
+    for run in ("cold", "warm"):
+        harvester = offline_collector(mock, path)
+        start = time.perf_counter()
+        harvester.setup()
+        results[f"sitemap_refresh_{run}_seconds"] = time.perf_counter() - start
+    results["n_companies"] = sum(
+        info["n_companies"] for info in harvester.language_overview
+    )
+    return results
+
+
+def bench_harvest(mock, path, data_path, calls_per_minute=None, **harvest_args):
+    """End to end harvest of all languages of the mock server"""
+    harvester = offline_collector(mock, path, calls_per_minute=calls_per_minute)
+    language_ids = list(harvester.available_languages)
+    start = time.perf_counter()
+    harvester.save_by_languages(data_path, language_ids, **harvest_args)
+    seconds = time.perf_counter() - start
+    metrics = harvester.metrics
+    n_pages = metrics.value("pages_persisted_total")
+    return dict(
+        harvest_seconds=seconds,
+        pages=n_pages,
+        pages_per_second=n_pages / seconds,
+        requests=sum(
+            value
+            for key, value in metrics.snapshot()["counters"].items()
+            if key.startswith("responses_total") and "redirect" not in key
+        ),
+        rate_limit_wait_seconds=metrics.value("rate_limit_wait_seconds"),
+        network_seconds=metrics.value("request_seconds"),
+        parse_seconds=metrics.value("parse_seconds"),
+        persist_seconds=metrics.value("persist_seconds"),
+        mb_downloaded=metrics.value("bytes_downloaded_total") / 2**20,
+    )
+
+
+def _sample_pages(mock, n_pages):
+    return [
+        mock.review_page(company, 1 + company % mock.max_pages)
+        for company in range(n_pages)
+    ]
+
+
+def bench_parse(mock, n_pages=200):
+    """Parse cost per page: fast path (scraper.page_infos) and lxml"""
+    contents = _sample_pages(mock, n_pages)
+    start = time.perf_counter()
+    for content in contents:
+        scraper.page_infos(content)
+    fast = (time.perf_counter() - start) / n_pages
+    start = time.perf_counter()
+    for content in contents:
+        tree = lxml.html.fromstring(content)
+        scraper.jsonld(tree)
+        scraper.structured_content_data(tree)
+    slow = (time.perf_counter() - start) / n_pages
+    return dict(
+        parse_ms_per_page=fast * 1000,
+        parse_lxml_ms_per_page=slow * 1000,
+        page_kb=sum(map(len, contents)) / n_pages / 2**10,
+    )
+
+
+def bench_persist(mock, data_path, output_format="tar", compression="gzip", n_pages=200):
+    """Persistence throughput of a writer backend (in the calling thread)"""
+    pages = [scraper.page_infos(content) for content in _sample_pages(mock, n_pages)]
+    name = f"persist-{output_format}-{compression}"
+    Path(data_path).mkdir(parents=True, exist_ok=True)
+    writer = open_writer(
+        data_path,
+        name,
+        output_format=output_format,
+        compression=compression,
+        background=False,
+        extract_reviews=output_format == "none",
+    )
+    start = time.perf_counter()
+    for nr, page in enumerate(pages):
+        writer.write(f"company{nr}.example", 1, page)
+    writer.close()
+    seconds = time.perf_counter() - start
+    size = sum(_size(path) for path in Path(data_path).glob(f"{name}*"))
+    return {
+        f"persist_{output_format}_{compression}_pages_per_second": n_pages / seconds,
+        f"persist_{output_format}_{compression}_mb_written": size / 2**20,
+    }
+
+
+def _size(path):
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def run(args):
+    mock = MockTrustpilot(
+        n_companies=args.n_companies,
+        max_pages=args.max_pages,
+        latency=args.latency,
+        error_rates={500: args.error_rate, 403: args.error_rate, 404: args.error_rate},
+        redirect_rate=args.redirect_rate,
+        padding=args.padding,
+    )
+    mock.serve()
+    tmp_path = Path(tempfile.mkdtemp(prefix="tp-harvester-benchmark-"))
+    results = dict(
+        n_companies_per_language=args.n_companies,
+        max_pages=args.max_pages,
+        latency=args.latency,
+        n_workers=args.n_workers,
+    )
+    try:
+        results |= bench_sitemaps(mock, tmp_path / "sitemaps")
+        results |= bench_harvest(
+            mock,
+            tmp_path / "sitemaps",
+            tmp_path / "harvest",
+            calls_per_minute=args.calls_per_minute,
+            n_workers=args.n_workers,
+            n_parse_workers=args.n_parse_workers,
+            output_format=args.output_format,
+            compression=args.compression,
+            dedup="none",
+        )
+        results |= bench_parse(mock)
+        for output_format in ("tar", "shards", "none"):
+            results |= bench_persist(mock, tmp_path / "persist", output_format)
+    finally:
+        mock.shutdown()
+        shutil.rmtree(tmp_path)
+    results["mock_requests"] = {str(k): v for k, v in mock.stats.items()}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the harvester against a local mock server."
+    )
+    parser.add_argument("--n_companies", type=int, help="Companies per language (2 languages).", default=100)
+    parser.add_argument("--max_pages", type=int, help="Most review pages of a company.", default=5)
+    parser.add_argument("--latency", type=float, help="Seconds added to each response of the mock server.", default=0.02)
+    parser.add_argument("--error_rate", type=float, help="Share of review page requests answered with 500, 403 and 404 (each).", default=0.0)
+    parser.add_argument("--redirect_rate", type=float, help="Share of companies redirecting to another url.", default=0.0)
+    parser.add_argument("--padding", type=int, help="Bytes of filler data in each review page.", default=50_000)
+    parser.add_argument("--calls_per_minute", type=int, help="Rate limit of the harvest (default: none).", default=None)
+    parser.add_argument("--n_workers", type=int, help="Requests in flight.", default=8)
+    parser.add_argument("--n_parse_workers", type=int, help="Parse processes.", default=None)
+    parser.add_argument("--output_format", type=str, choices=OUTPUT_FORMATS, default="shards")
+    parser.add_argument("--compression", type=str, choices=COMPRESSIONS, default="gzip")
+    parser.add_argument("--json", type=str, help="Write the results to this file.", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+    print()
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{key:45} {value}")
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
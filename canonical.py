@@ -0,0 +1,45 @@
+from collections import defaultdict
+
+from loader import company_key_from_url
+
+DEDUP_MODES = ("none", "once", "last_mod")
+
+
+def canonical_company_key(url):
+    """Locale independent key of a company review page url.
+    e.g. 'https://de.trustpilot.com/review/www.example.com' and
+    'https://at.trustpilot.com/review/www.example.com' -> 'www.example.com'
+    """
+    return company_key_from_url(url).strip("/").lower()
+
+
+def assign_locales(language_company_urls, language_ids, mode="once"):
+    """Assign the companies listed in several locales to the locales to
+    harvest them from.
+
+    Modes:
+     * "none": every locale harvests all its companies
+     * "once": each company is harvested once, from the first locale in
+       `language_ids` listing it
+     * "last_mod": additionally from each locale whose sitemap `last_mod`
+       differs from the locales already chosen (the content differs)
+
+    Returns a dict language id -> set of canonical company keys.
+    """
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"Unknown dedup mode {mode}. Use one of {DEDUP_MODES}")
+    assignment = {}
+    chosen_last_mods = defaultdict(set)
+    for lang_id in language_ids:
+        company_keys = set()
+        for url_info in language_company_urls[lang_id]:
+            key = canonical_company_key(url_info["url"])
+            last_mods = chosen_last_mods[key]
+            if mode == "once" and last_mods:
+                continue
+            if mode == "last_mod" and url_info["last_mod"] in last_mods:
+                continue
+            last_mods.add(url_info["last_mod"])
+            company_keys.add(key)
+        assignment[lang_id] = company_keys
+    return assignment
@@ -0,0 +1,329 @@
+import sqlite3
+import datetime
+import threading
+
+from loader import company_key_from_url
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    language_id TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    n_sessions INTEGER NOT NULL DEFAULT 1,
+    finished INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS companies (
+    run_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    company_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    last_mod TEXT,
+    pages_fetched INTEGER NOT NULL DEFAULT 0,
+    next_page INTEGER DEFAULT 1,
+    newest_review_date TEXT,
+    failed INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    PRIMARY KEY (run_id, company_key)
+);
+CREATE INDEX IF NOT EXISTS companies_pending
+    ON companies (run_id, next_page, position);
+CREATE TABLE IF NOT EXISTS pages (
+    run_id INTEGER NOT NULL,
+    company_key TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    PRIMARY KEY (run_id, company_key, page)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    language_id TEXT NOT NULL,
+    company_key TEXT NOT NULL,
+    last_mod TEXT,
+    newest_review_date TEXT,
+    PRIMARY KEY (language_id, company_key)
+);
+"""
+
+# columns added after the first version of the schema
+MIGRATIONS = {
+    "companies": {
+        "newest_review_date": "TEXT",
+        "failed": "INTEGER NOT NULL DEFAULT 0",
+        "lease_owner": "TEXT",
+        "lease_expires": "REAL",
+    },
+}
+# current unix time in SQLite (evaluated when the statement is executed)
+SQL_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+class CheckpointStore:
+    """Persistent progress of a harvest run of one language (SQLite).
+
+    For each company of a run the fetched pages and the next page due are
+    stored. Updates are staged with `record_page` and only written by
+    `commit`, which has to be called after the corresponding pages are
+    persisted. An unfinished run is resumed by the next store opened for
+    the same language. `mark` and `commit(upto)` allow to commit from
+    another thread (e.g. a background writer) only the updates of pages
+    persisted so far.
+
+    Companies finished without errors update the watermarks of the
+    language (sitemap `last_mod` and newest review date), which are used by
+    incremental harvests.
+    """
+
+    # seconds a leased company is reserved for a worker (see work_queue)
+    lease_seconds = 600
+    # owner of the leases (None: companies are not leased)
+    worker_id = None
+
+    def __init__(self, path, language_id):
+        self.path = path
+        self.language_id = language_id
+        # several processes may share the file (see work_queue)
+        self.connection = sqlite3.connect(
+            str(path), timeout=60, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+        self._lock = threading.RLock()
+        self._staged = []
+        self._n_staged = 0
+        self._n_committed = 0
+        self.run_id = None
+        self.start_date = None
+        self.n_sessions = 0
+        with self.connection:
+            self._open_unfinished_run()
+
+    def _open_unfinished_run(self):
+        row = self.connection.execute(
+            "SELECT run_id, start_date, n_sessions FROM runs "
+            "WHERE language_id = ? AND finished = 0 "
+            "ORDER BY run_id DESC LIMIT 1",
+            (self.language_id,),
+        ).fetchone()
+        if row is not None:
+            self.run_id, self.start_date, n_sessions = row
+            self.n_sessions = n_sessions + 1
+            self.connection.execute(
+                "UPDATE runs SET n_sessions = ? WHERE run_id = ?",
+                (self.n_sessions, self.run_id),
+            )
+
+    def _migrate(self):
+        for table, columns in MIGRATIONS.items():
+            rows = self.connection.execute(f"PRAGMA table_info({table})")
+            existing = {row[1] for row in rows}
+            for column, definition in columns.items():
+                if column not in existing:
+                    self.connection.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+                    )
+        self.connection.commit()
+
+    @property
+    def resumed(self):
+        return self.run_id is not None
+
+    def start(self, url_infos, start_date=None):
+        """Start a new run for the (ordered) company urls.
+        If another process started a run in the meantime, it is joined.
+        """
+        if start_date is None:
+            start_date = datetime.datetime.today().strftime("%Y-%m-%d")
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self._open_unfinished_run()
+            if self.resumed:
+                return
+            cursor = self.connection.execute(
+                "INSERT INTO runs (language_id, start_date) VALUES (?, ?)",
+                (self.language_id, start_date),
+            )
+            self.run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO companies "
+                "(run_id, position, company_key, url, last_mod) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        self.run_id,
+                        position,
+                        company_key_from_url(url_info["url"]),
+                        url_info["url"],
+                        url_info["last_mod"],
+                    )
+                    for position, url_info in enumerate(url_infos)
+                ),
+            )
+        self.start_date = start_date
+        self.n_sessions = 1
+
+    def pending(self):
+        """Yields the company url infos with the next page due, in the run
+        order."""
+        rows = self.connection.execute(
+            "SELECT url, last_mod, next_page FROM companies "
+            "WHERE run_id = ? AND next_page IS NOT NULL ORDER BY position",
+            (self.run_id,),
+        )
+        for url, last_mod, next_page in rows:
+            yield dict(url=url, last_mod=last_mod, page=next_page)
+
+    def n_companies(self):
+        (n,) = self.connection.execute(
+            "SELECT COUNT(*) FROM companies WHERE run_id = ?", (self.run_id,)
+        ).fetchone()
+        return n
+
+    def record_page(
+        self,
+        company_key,
+        page,
+        next_page,
+        fetched=True,
+        failed=False,
+        newest_review_date=None,
+    ):
+        """Stage the result of requesting `page` of a company.
+        `next_page` None marks the company as finished.
+        """
+        staged = []
+        if fetched:
+            staged.append(
+                (
+                    "INSERT OR IGNORE INTO pages (run_id, company_key, page) "
+                    "VALUES (?, ?, ?)",
+                    (self.run_id, company_key, page),
+                )
+            )
+        staged.append(
+            (
+                "UPDATE companies SET next_page = ?, "
+                "pages_fetched = pages_fetched + ?, "
+                "failed = MAX(failed, ?), "
+                "newest_review_date = NULLIF(MAX("
+                "COALESCE(newest_review_date, ''), COALESCE(?, '')), ''), "
+                # progress renews the lease of a leased company
+                "lease_expires = CASE WHEN lease_owner IS NULL THEN NULL "
+                f"ELSE {SQL_NOW} + ? END "
+                "WHERE run_id = ? AND company_key = ? "
+                # no progress of a worker whose lease was taken over
+                "AND (? IS NULL OR lease_owner = ?)",
+                (
+                    next_page,
+                    int(fetched),
+                    int(failed),
+                    newest_review_date,
+                    self.lease_seconds,
+                    self.run_id,
+                    company_key,
+                    self.worker_id,
+                    self.worker_id,
+                ),
+            )
+        )
+        if next_page is None:
+            staged.append(
+                (
+                    "INSERT INTO watermarks "
+                    "(language_id, company_key, last_mod, newest_review_date) "
+                    "SELECT ?, company_key, last_mod, newest_review_date "
+                    "FROM companies "
+                    "WHERE run_id = ? AND company_key = ? AND failed = 0 "
+                    "AND (? IS NULL OR lease_owner = ?) "
+                    "ON CONFLICT (language_id, company_key) DO UPDATE SET "
+                    "last_mod = excluded.last_mod, "
+                    "newest_review_date = NULLIF(MAX("
+                    "COALESCE(excluded.newest_review_date, ''), "
+                    "COALESCE(newest_review_date, '')), '')",
+                    (
+                        self.language_id,
+                        self.run_id,
+                        company_key,
+                        self.worker_id,
+                        self.worker_id,
+                    ),
+                )
+            )
+        with self._lock:
+            self._staged.extend(staged)
+            self._n_staged += len(staged)
+
+    def fetched_pages(self, company_key):
+        """Pages of a company fetched (and committed) in this run."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT page FROM pages WHERE run_id = ? AND company_key = ?",
+                (self.run_id, company_key),
+            ).fetchall()
+        return {page for (page,) in rows}
+
+    def newest_review_date(self, company_key):
+        """Newest review date of a company from the previous harvests."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT newest_review_date FROM watermarks "
+                "WHERE language_id = ? AND company_key = ?",
+                (self.language_id, company_key),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def modified(self, url_infos):
+        """Yields the company url infos whose sitemap `last_mod` changed
+        since the last harvest (or which were never harvested)."""
+        for url_info in url_infos:
+            row = self.connection.execute(
+                "SELECT last_mod FROM watermarks "
+                "WHERE language_id = ? AND company_key = ?",
+                (self.language_id, company_key_from_url(url_info["url"])),
+            ).fetchone()
+            if row is None or row[0] is None or row[0] != url_info["last_mod"]:
+                yield url_info
+
+    def page_counts(self):
+        """Most pages fetched of each company in a run of the language
+        (the known review volume, ~20 reviews per page)."""
+        rows = self.connection.execute(
+            "SELECT company_key, MAX(pages_fetched) FROM companies "
+            "JOIN runs USING (run_id) WHERE language_id = ? "
+            "GROUP BY company_key",
+            (self.language_id,),
+        )
+        return dict(rows)
+
+    def mark(self):
+        """Token for all updates staged so far (see `commit`)."""
+        with self._lock:
+            return self._n_staged
+
+    def commit(self, upto=None):
+        """Write the staged updates (up to the token `upto` of `mark`)."""
+        with self._lock:
+            if upto is None:
+                upto = self._n_staged
+            n = upto - self._n_committed
+            if n <= 0:
+                return
+            staged, self._staged = self._staged[:n], self._staged[n:]
+            self._n_committed = upto
+            with self.connection:
+                for sql, params in staged:
+                    self.connection.execute(sql, params)
+
+    def finish(self):
+        """Commit and mark the run as finished if no company is pending."""
+        with self._lock:
+            self.commit()
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE runs SET finished = 1 WHERE run_id = ? "
+                    "AND NOT EXISTS (SELECT 1 FROM companies "
+                    "WHERE run_id = ? AND next_page IS NOT NULL)",
+                    (self.run_id, self.run_id),
+                )
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,290 @@
+import re
+import gzip
+import json
+import heapq
+import shutil
+import logging
+import argparse
+from pathlib import Path
+from itertools import groupby
+
+import scraper
+from reader import (
+    OTHER_OUTPUT_PATTERN,
+    WORKER_SUFFIX_PATTERN,
+    HarvestReader,
+    harvest_paths,
+    stream_pages,
+)
+from writer import COMPRESSIONS, open_writer
+
+logger = logging.getLogger(__name__)
+HARVEST_PREFIX_PATTERN = r"^([0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}})-{language_id}-trustpilot-reviews-"
+HARVEST_PATTERN = (
+    HARVEST_PREFIX_PATTERN
+    + r"(jsonld|snapshot)"
+    + WORKER_SUFFIX_PATTERN
+    + r"(?:-[0-9]+)?(?:\.tar\.gz)?$"
+)
+# key of the company record (sorts before the review ids)
+COMPANY = ""
+
+
+def compact(
+    inputs,
+    base_path,
+    name,
+    compression="gzip",
+    max_records=100_000,
+    extract_reviews=False,
+    fan_in=64,
+):
+    """Merge harvests of a language into one snapshot: the newest known
+    version of each company and of each of its reviews (by review id).
+
+    `inputs` are the harvests from oldest to newest, each a path or a list
+    of paths (tar.gz parts and shard directories, see
+    `reader.harvest_paths`), e.g. an older snapshot followed by the daily
+    runs since. Within an input later pages (parts) win. External merge:
+    the records are sorted in runs of `max_records` on disk and merged
+    (at most `fan_in` runs at once), only the reviews of one company are
+    held in memory. The snapshot is written as shards (`<name>/`, see
+    `writer.ShardWriter`) in pages of 20 reviews (newest first, the
+    company fields on page 1) and indexed for `reader.HarvestReader`.
+    It is written under a temporary name and renamed when complete, so
+    `<name>/` only exists for a finished snapshot.
+    Returns the number of companies and reviews.
+    """
+    base_path = Path(base_path)
+    base_path.mkdir(parents=True, exist_ok=True)
+    partial_name = f".{name}-partial"
+    tmp_path = base_path / f".{name}-runs"
+    for path in (base_path / partial_name, base_path / f"{partial_name}-reviews", tmp_path):
+        # left by a killed compaction
+        if path.exists():
+            shutil.rmtree(path)
+    tmp_path.mkdir()
+    try:
+        runs = _sorted_runs(inputs, tmp_path, max_records)
+        runs = _merge_runs(runs, tmp_path, fan_in)
+        writer = open_writer(
+            base_path,
+            partial_name,
+            output_format="shards",
+            compression=compression,
+            background=False,
+            extract_reviews=extract_reviews,
+        )
+        n_companies = 0
+        n_reviews = 0
+        try:
+            merged = heapq.merge(*(_read_run(run) for run in runs), key=_sort_key)
+            for company_key, records in groupby(merged, key=lambda record: record[0]):
+                company, reviews = _newest(records)
+                for page, data in enumerate(_pages(company_key, company, reviews), 1):
+                    writer.write(company_key, page, data)
+                n_companies += 1
+                n_reviews += len(reviews)
+        finally:
+            writer.close()
+    finally:
+        shutil.rmtree(tmp_path)
+    if extract_reviews:
+        _replace(base_path / f"{partial_name}-reviews", base_path / f"{name}-reviews")
+    _replace(base_path / partial_name, base_path / name)
+    HarvestReader(base_path / name).close()
+    return n_companies, n_reviews
+
+
+def _replace(path, target):
+    if target.exists():
+        shutil.rmtree(target)
+    path.rename(target)
+
+
+def _sort_key(record):
+    return record[:4]
+
+
+def _sorted_runs(inputs, tmp_path, max_records):
+    """Sorted runs `(company_key, record_id, -seq, -position, data)` of the
+    inputs (`seq`: position of the input, `position`: of the page within
+    the input; the newest version sorts first)"""
+    runs = []
+    records = []
+    for seq, paths in enumerate(inputs):
+        for position, (company_key, page, data) in enumerate(stream_pages(paths)):
+            records.extend(_records(company_key, page, data, seq, position))
+            if len(records) >= max_records:
+                records.sort(key=_sort_key)
+                runs.append(_write_run(records, tmp_path / f"run-0-{len(runs):05d}.jsonl.gz"))
+                records = []
+    if records:
+        records.sort(key=_sort_key)
+        runs.append(_write_run(records, tmp_path / f"run-0-{len(runs):05d}.jsonl.gz"))
+    return runs
+
+
+def _merge_runs(runs, tmp_path, fan_in):
+    """Merge groups of `fan_in` runs in passes until at most `fan_in` runs
+    are left (bounds the files open at once)."""
+    n_pass = 0
+    while len(runs) > fan_in:
+        n_pass += 1
+        merged_runs = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start : start + fan_in]
+            merged = heapq.merge(*(_read_run(run) for run in group), key=_sort_key)
+            filename = tmp_path / f"run-{n_pass}-{len(merged_runs):05d}.jsonl.gz"
+            merged_runs.append(_write_run(merged, filename))
+            for run in group:
+                run.unlink()
+        runs = merged_runs
+    return runs
+
+
+def _records(company_key, page, data, seq, position):
+    """Records of a page: its reviews and (page 1) the company fields"""
+    records = []
+    for review in scraper.reviews(data["jsonld"]):
+        review_id = scraper.review_id(review)
+        if review_id is None:
+            # no id: identified by its content
+            review_id = json.dumps(review, sort_keys=True)
+        records.append((company_key, review_id, -seq, -position, review))
+    if page == 1:
+        company = dict(
+            url_base=data.get("url_base"),
+            url_base_last_mod=data.get("url_base_last_mod"),
+            date=data.get("date"),
+            nodes=_company_nodes(data["jsonld"]),
+        )
+        records.append((company_key, COMPANY, -seq, -position, company))
+    return records
+
+
+def _company_nodes(json_ld_contents):
+    """The jsonld nodes of a page which are no reviews"""
+    nodes = []
+    for content in json_ld_contents:
+        if isinstance(content, dict) and "@graph" in content:
+            nodes.extend(
+                node for node in content["@graph"] if node.get("@type") != "Review"
+            )
+        elif not (isinstance(content, dict) and content.get("@type") == "Review"):
+            nodes.append(content)
+    return nodes
+
+
+def _write_run(records, filename):
+    """Write sorted records"""
+    with gzip.open(filename, "wt", encoding="utf-8", compresslevel=1) as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return filename
+
+
+def _read_run(filename):
+    with gzip.open(filename, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def _newest(records):
+    """The company fields and the reviews of a company (newest version of
+    each, records sorted by id and newest version first)"""
+    company = None
+    reviews = []
+    for record_id, versions in groupby(records, key=lambda record: record[1]):
+        data = next(versions)[-1]
+        if record_id == COMPANY:
+            company = data
+        else:
+            reviews.append(data)
+    reviews.sort(key=lambda review: review.get("datePublished") or "", reverse=True)
+    return company, reviews
+
+
+def _pages(company_key, company, reviews):
+    """Snapshot pages of a company: like harvested pages (jsonld with 20
+    reviews, newest first), the company fields on page 1"""
+    company = company or dict(nodes=[])
+    n_pages = max(-(-len(reviews) // scraper.REVIEWS_PER_PAGE), 1)
+    for page in range(1, n_pages + 1):
+        start = (page - 1) * scraper.REVIEWS_PER_PAGE
+        graph = reviews[start : start + scraper.REVIEWS_PER_PAGE]
+        data = dict(company_key=company_key, page=page)
+        if page == 1:
+            graph = company["nodes"] + graph
+            data |= {key: value for key, value in company.items() if key != "nodes"}
+        data["jsonld"] = [{"@context": "https://schema.org", "@graph": graph}]
+        data["structured_page_content"] = None
+        yield data
+
+
+def language_inputs(base_path, language_id):
+    """Harvests of a language in `base_path` to compact, oldest first:
+    the newest snapshot (if any) and the harvests of later dates.
+    Returns the inputs and the date of the newest one.
+    Files named like harvests but not matching are skipped with a
+    warning."""
+    base_path = Path(base_path)
+    pattern = re.compile(HARVEST_PATTERN.format(language_id=re.escape(language_id)))
+    prefix = re.compile(HARVEST_PREFIX_PATTERN.format(language_id=re.escape(language_id)))
+    harvest_dates = set()
+    snapshot_dates = set()
+    skipped = []
+    for path in base_path.iterdir():
+        match = pattern.match(path.name)
+        if match:
+            date, kind = match.group(1, 2)
+            (snapshot_dates if kind == "snapshot" else harvest_dates).add(date)
+        elif prefix.match(path.name) and not OTHER_OUTPUT_PATTERN.search(path.name):
+            skipped.append(path)
+    inputs = []
+    start = max(snapshot_dates, default="")
+    for path in skipped:
+        date = prefix.match(path.name).group(1)
+        # files of the dates read are reported by harvest_paths
+        if date > start and date not in harvest_dates:
+            logger.warning(f"Skipped {path}: not a harvest of {language_id}.")
+    if start:
+        inputs.append(harvest_paths(base_path, f"{start}-{language_id}-trustpilot-reviews-snapshot"))
+    dates = sorted(date for date in harvest_dates if date > start)
+    for date in dates:
+        inputs.append(harvest_paths(base_path, f"{date}-{language_id}-trustpilot-reviews-jsonld"))
+    return inputs, max(dates, default=start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the harvests of a language into one snapshot (newest version of each company and review)."
+    )
+    parser.add_argument("data_path", type=str, help="The path of the harvests. The snapshot is stored here as well.")
+    parser.add_argument("language_id", type=str, help="The language of the harvests (e.g. de-de).")
+    parser.add_argument("--compression", type=str, choices=COMPRESSIONS, default="gzip")
+    parser.add_argument("--max_records", type=int, help="Records sorted in memory at once (external merge).", default=100_000)
+    parser.add_argument("--fan_in", type=int, help="Sorted runs merged at once (more runs are merged in passes).", default=64)
+    parser.add_argument("--extract_reviews", action="store_true", help="Write one record per review in addition.")
+    args = parser.parse_args()
+    inputs, date = language_inputs(args.data_path, args.language_id)
+    if not inputs:
+        parser.error(f"No harvest of {args.language_id} found in {args.data_path}.")
+    name = f"{date}-{args.language_id}-trustpilot-reviews-snapshot"
+    if (Path(args.data_path) / name).exists():
+        print(f"{name} is up to date (no newer harvest).")
+        return
+    n_companies, n_reviews = compact(
+        inputs,
+        args.data_path,
+        name,
+        compression=args.compression,
+        max_records=args.max_records,
+        extract_reviews=args.extract_reviews,
+        fan_in=args.fan_in,
+    )
+    print(f"{name}: {n_companies} companies, {n_reviews} reviews from {len(inputs)} harvests.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,311 @@
 import time
-from functools import wraps
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
 
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_result
+import requests
+from lxml import etree
+from tenacity import retry, stop_after_attempt, retry_if_exception_type
+
+# responses worth another try later (throttling, server errors)
+RETRY_STATUS_CODES = (403, 429, 500, 502, 503, 504)
+
+
+class TransientError(Exception):
+    """A request failed for a reason which may pass: a throttling or
+    server error response (`status`) or a network error (`status` None).
+    `retry_after` is the `Retry-After` header of the response."""
+
+    def __init__(self, url, status=None, retry_after=None):
+        reason = "network error" if status is None else f"status {status}"
+        super().__init__(f"{reason} for {url}")
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, base, max_wait, retry_after=None):
+    """Seconds to wait before the next try after `attempt` failed tries:
+    exponential backoff with full jitter, at least `Retry-After`."""
+    delay = random.uniform(0, min(max_wait, base * 2 ** (attempt - 1)))
+    return max(delay, parse_retry_after(retry_after) or 0.0)
 
 
 def get_function_get_response(
-    session, retry_attempts, retry_wait, timeout, max_calls_per_minute, logger
+    session,
+    retry_attempts,
+    retry_wait,
+    timeout,
+    rate_limiter,
+    logger,
+    metrics=None,
+    breaker=None,
+    max_retry_wait=60,
 ):
+    """Rate limited GET.
+    Throttling and server errors (`RETRY_STATUS_CODES`) and network errors
+    are tried `retry_attempts` times in total (waiting in the calling
+    thread, see `backoff_delay`) before `TransientError` is raised. With
+    `retry_attempts=1` the caller handles the retries itself.
+    With `metrics` (metrics.Metrics) the time waiting for the rate limiter
+    and in the network, the response status codes and the downloaded bytes
+    are recorded. A `breaker` (CircuitBreaker) pauses the requests to a
+    host with too many errors.
+    """
+
+    def wait(retry_state):
+        error = retry_state.outcome.exception()
+        return backoff_delay(
+            retry_state.attempt_number, retry_wait, max_retry_wait, error.retry_after
+        )
+
     retry_decorator = retry(
         stop=stop_after_attempt(retry_attempts),
-        wait=wait_fixed(retry_wait),
-        retry=retry_if_result(lambda x: x == 500),
+        wait=wait,
+        retry=retry_if_exception_type(TransientError),
+        reraise=True,
     )
 
     @retry_decorator
-    @requests_per_minute(max_calls_per_minute, logger)
-    def get_response(url):
-        resp = session.get(url, timeout=timeout)
-        if resp.status_code == 500:
-            logger.warning(
-                f"Server error (500) encountered at {url}, retrying..."
+    def get_response(url, **kwargs):
+        host = urlsplit(url).netloc
+        if breaker is not None:
+            if metrics is None:
+                breaker.acquire(host)
+            else:
+                with metrics.timer("circuit_breaker_wait_seconds"):
+                    breaker.acquire(host)
+        if metrics is None:
+            rate_limiter.acquire()
+        else:
+            with metrics.timer("rate_limit_wait_seconds"):
+                rate_limiter.acquire()
+        try:
+            if metrics is None:
+                resp = session.get(url, timeout=timeout, **kwargs)
+            else:
+                resp = _metered_get(session, url, timeout, metrics, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record_outcome(breaker, metrics, host, success=False)
+            raise TransientError(url) from e
+        rate_limiter.feedback(
+            resp.status_code, resp.headers.get("Retry-After")
+        )
+        if metrics is not None and rate_limiter.rate_per_minute is not None:
+            metrics.set("rate_per_minute", rate_limiter.rate_per_minute)
+        transient = resp.status_code in RETRY_STATUS_CODES
+        _record_outcome(breaker, metrics, host, success=not transient)
+        if transient:
+            logger.warning(f"Transient error ({resp.status_code}) encountered at {url}.")
+            resp.close()
+            raise TransientError(
+                url, resp.status_code, resp.headers.get("Retry-After")
             )
-            return 500
         resp.raise_for_status()  # Raise an HTTPError for bad responses
         return resp
 
     return get_response
 
 
-def requests_per_minute(max_calls_per_minute, logger):
-    calls = []
-
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            nonlocal calls
-            now = time.time()
-            # Remove calls that are older than 60 seconds
-            calls = [call for call in calls if now - call < 60]
-            if (
-                max_calls_per_minute is not None
-                and len(calls) >= max_calls_per_minute
-            ):
-                # Calculate the time to wait until the oldest call is older than 60 seconds
-                wait_time = 60 - (now - calls[0])
-                logger.debug(
-                    f"Wait {wait_time:0.2f} seconds. (Max requests per minute: {max_calls_per_minute})"
+def _record_outcome(breaker, metrics, host, success):
+    if breaker is not None and breaker.record(host, success):
+        if metrics is not None:
+            metrics.inc("circuit_breaker_trips_total")
+
+
+def _metered_get(session, url, timeout, metrics, **kwargs):
+    try:
+        with metrics.timer("request_seconds"):
+            resp = session.get(url, timeout=timeout, **kwargs)
+    except Exception:
+        metrics.inc("responses_total", status="error")
+        raise
+    if resp.history:
+        metrics.inc("responses_total", status="redirect")
+    metrics.inc("responses_total", status=resp.status_code)
+    if not kwargs.get("stream"):
+        metrics.inc("bytes_downloaded_total", len(resp.content))
+    return resp
+
+
+THROTTLE_STATUS_CODES = (403, 429, 500, 503)
+
+
+class RateLimiter:
+    """Token bucket rate limiter with adaptive throttling (AIMD).
+
+    Each request costs one token (O(1), no call history). Tokens are
+    reserved under a lock and the caller sleeps outside of it, so only the
+    calling thread (`acquire`) or task (`acquire_async`) waits.
+    The rate grows additively with successful responses (by `increase`
+    calls per minute for every minute worth of requests) and is multiplied
+    by `decrease_factor` on throttling responses (403/429/500/503).
+    A `Retry-After` header pauses all callers for the given time, the
+    requests reserved meanwhile are spaced at the current rate after it.
+    `calls_per_minute=None` disables the limit.
+    """
+
+    def __init__(
+        self,
+        calls_per_minute,
+        max_calls_per_minute=None,
+        min_calls_per_minute=1,
+        increase=5,
+        decrease_factor=0.5,
+        burst=1,
+        logger=None,
+    ):
+        self.max_calls_per_minute = max_calls_per_minute or calls_per_minute
+        self.min_calls_per_minute = min_calls_per_minute
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.capacity = burst
+        self.logger = logger or logging.getLogger(__name__)
+        self._rate = None if calls_per_minute is None else calls_per_minute / 60
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate_per_minute(self):
+        """Current (adapted) rate in calls per minute."""
+        if self._rate is None:
+            return None
+        return self._rate * 60
+
+    def reserve(self):
+        """Take one token and return the seconds to wait before using it."""
+        if self._rate is None:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            # after a block (`_updated` in the future) the reservations
+            # follow each other at the current rate
+            return max(0.0, self._updated - now) + max(0.0, -self._tokens / self._rate)
+
+    def _refill(self, now):
+        if now > self._updated:
+            elapsed = now - self._updated
+            self._tokens = min(self.capacity, self._tokens + elapsed * self._rate)
+            self._updated = now
+
+    def acquire(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            self.logger.debug(
+                f"Wait {wait_time:0.2f} seconds. (Requests per minute: {self.rate_per_minute:.1f})"
+            )
+            time.sleep(wait_time)
+
+    async def acquire_async(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    def feedback(self, status_code, retry_after=None):
+        """Adapt the rate to the response of the server."""
+        if self._rate is None:
+            return
+        with self._lock:
+            rate = self._rate * 60
+            if status_code in THROTTLE_STATUS_CODES:
+                rate = max(self.min_calls_per_minute, rate * self.decrease_factor)
+                pause = parse_retry_after(retry_after)
+                if pause:
+                    # no tokens accrue until the block ends (at most one is ready then)
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now + pause > self._updated:
+                        self._updated = now + pause
+                        self._tokens = min(self._tokens, 1)
+                self.logger.info(
+                    f"Throttled ({status_code}). Rate reduced to {rate:.1f} requests per minute."
                 )
-                time.sleep(wait_time)
-                # After waiting, clean up old calls again and proceed
-            now = time.time()
-            calls = [call for call in calls if now - call < 60]
-            calls.append(now)
-            return func(*args, **kwargs)
+            else:
+                rate = min(self.max_calls_per_minute, rate + self.increase / rate)
+            self._rate = rate / 60
+
+
+def parse_retry_after(retry_after):
+    """Seconds to wait for a `Retry-After` header value (seconds or date)."""
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """Pauses the requests to a host when its error rate spikes.
 
-        return wrapper
+    The outcomes of the last `window` requests to each host are kept. If
+    at least `min_requests` are known and the share of errors reaches
+    `threshold`, the breaker opens: requests to the host wait (`acquire`)
+    for `pause` seconds. The pause doubles (up to `max_pause`) each time
+    the breaker opens again before a window without errors.
+    """
+
+    def __init__(
+        self,
+        threshold=0.5,
+        window=20,
+        min_requests=10,
+        pause=30,
+        max_pause=600,
+        logger=None,
+    ):
+        self.threshold = threshold
+        self.window = window
+        self.min_requests = min_requests
+        self.pause = pause
+        self.max_pause = max_pause
+        self.logger = logger or logging.getLogger(__name__)
+        self._outcomes = {}
+        self._pauses = {}
+        self._open_until = {}
+        self._lock = threading.Lock()
+
+    def wait_time(self, host):
+        """Seconds until requests to the host are allowed again."""
+        with self._lock:
+            return max(0.0, self._open_until.get(host, 0.0) - time.monotonic())
 
-    return decorator
+    def acquire(self, host):
+        wait_time = self.wait_time(host)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def record(self, host, success):
+        """Record the outcome of a request. Returns True if the breaker
+        opened."""
+        with self._lock:
+            outcomes = self._outcomes.setdefault(host, deque(maxlen=self.window))
+            outcomes.append(success)
+            n_errors = outcomes.count(False)
+            if len(outcomes) >= self.min_requests and n_errors >= self.threshold * len(outcomes):
+                pause = self._pauses.get(host, self.pause)
+                self._open_until[host] = time.monotonic() + pause
+                self._pauses[host] = min(self.max_pause, pause * 2)
+                outcomes.clear()
+                self.logger.warning(
+                    f"{n_errors} errors in the last requests to {host}. Paused for {pause} seconds."
+                )
+                return True
+            if n_errors == 0 and len(outcomes) == self.window:
+                self._pauses.pop(host, None)
+            return False
 
 
 NAME_SPACES = {"sms": "http://www.sitemaps.org/schemas/sitemap/0.9"}
@@ -70,28 +319,65 @@ def extract_sitemap_urls(tree):
 
 
 def extract_company_urls(tree):
-    slag_pattern="/review/"
     """extract all company urls from a sitemap url
     Extraction is based on sitmap xml format.
     """
     url_elements = tree.xpath("sms:url", namespaces=NAME_SPACES)
     url_infos = []
     for url_element in url_elements:
-        url = url_element.xpath("sms:loc", namespaces=NAME_SPACES)[0].text
-        last_mod_elements = url_element.xpath(
-            "sms:lastmod", namespaces=NAME_SPACES
-        )
-        last_mod = None
-        if last_mod_elements:
-            last_mod = last_mod_elements[0].text
-        if "/location/" in url:
-            # do not use concrete locations of companies
-            continue
-        if url.endswith("location"):
-            # do not use location overviews of companies
-            continue
-        if "/review/" not in url:
-            # do only use urls with review (company review pages)
-            continue
-        url_infos.append(dict(url=url, last_mod=last_mod))
+        url_info = _company_url_info(url_element)
+        if url_info is not None:
+            url_infos.append(url_info)
     return url_infos
+
+
+def iter_sitemap_urls(source):
+    """Streaming version of `extract_sitemap_urls` for a file like object"""
+    for element in _iterparse(source, "sitemap"):
+        loc = element.find("sms:loc", namespaces=NAME_SPACES)
+        if loc is not None:
+            yield loc.text
+
+
+def iter_company_urls(source):
+    """Streaming version of `extract_company_urls` for a file like object.
+    Parsed elements are freed, the memory usage is constant.
+    """
+    for element in _iterparse(source, "url"):
+        url_info = _company_url_info(element)
+        if url_info is not None:
+            yield url_info
+
+
+def _iterparse(source, tag):
+    tag = f"{{{NAME_SPACES['sms']}}}{tag}"
+    for _, element in etree.iterparse(source, events=("end",), tag=tag):
+        yield element
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def _company_url_info(url_element):
+    url = url_element.xpath("sms:loc", namespaces=NAME_SPACES)[0].text
+    last_mod_elements = url_element.xpath(
+        "sms:lastmod", namespaces=NAME_SPACES
+    )
+    last_mod = None
+    if last_mod_elements:
+        last_mod = last_mod_elements[0].text
+    if "/location/" in url:
+        # do not use concrete locations of companies
+        return None
+    if url.endswith("location"):
+        # do not use location overviews of companies
+        return None
+    if "/review/" not in url:
+        # do only use urls with review (company review pages)
+        return None
+    return dict(url=url, last_mod=last_mod)
+
+
+def company_key_from_url(url):
+    """Company key of a company review page url (path after '/review/')"""
+    return url.split("/review/")[1]
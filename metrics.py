@@ -0,0 +1,222 @@
+import json
+import time
+import bisect
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+PREFIX = "tp_harvester_"
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Counts of observed values by bucket (upper bounds)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Cumulative counts by upper bound (as in Prometheus)"""
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return dict(count=self.count, sum=self.sum, buckets=buckets)
+
+
+class Metrics:
+    """Thread safe counters, gauges and histograms of a harvest.
+
+    Metrics are identified by name and labels, e.g.
+    `inc("responses_total", status="200")`. Names used by the harvester:
+     * counters: `responses_total` (by status: code, "redirect", "error"),
+       `bytes_downloaded_total`, `pages_persisted_total`
+     * histograms (seconds): `request_seconds` (network),
+       `rate_limit_wait_seconds`, `parse_seconds`, `persist_seconds`
+     * gauges: `frontier_size`, `writer_queue_size`, `rate_per_minute`
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.start_time = time.time()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[_key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the block (seconds)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def value(self, name, **labels):
+        """Value of a counter or gauge, sum of a histogram (0 if unset)"""
+        key = _key(name, labels)
+        with self._lock:
+            if key in self.histograms:
+                return self.histograms[key].sum
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                time=time.time(),
+                uptime_seconds=time.time() - self.start_time,
+                counters={_name(key): value for key, value in self.counters.items()},
+                gauges={_name(key): value for key, value in self.gauges.items()},
+                histograms={
+                    _name(key): histogram.snapshot()
+                    for key, histogram in self.histograms.items()
+                },
+            )
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def to_prometheus(self):
+        """Snapshot in the Prometheus text format"""
+        snapshot = self.snapshot()
+        lines = []
+        types = set()
+
+        def add_type(name, kind):
+            if name not in types:
+                types.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(
+                (key, histogram.snapshot()) for key, histogram in self.histograms.items()
+            )
+        for (name, labels), value in counters:
+            add_type(name, "counter")
+            lines.append(f"{PREFIX}{_name((name, labels))} {value:g}")
+        for (name, labels), value in gauges:
+            add_type(name, "gauge")
+            lines.append(f"{PREFIX}{_name((name, labels))} {value:g}")
+        for (name, labels), histogram in histograms:
+            add_type(name, "histogram")
+            for bound, count in histogram["buckets"].items():
+                bucket_labels = labels + (("le", bound),)
+                lines.append(f"{PREFIX}{_name((name + '_bucket', bucket_labels))} {count}")
+            lines.append(f"{PREFIX}{_name((name + '_sum', labels))} {histogram['sum']:g}")
+            lines.append(f"{PREFIX}{_name((name + '_count', labels))} {histogram['count']}")
+        add_type("uptime_seconds", "gauge")
+        lines.append(f"{PREFIX}uptime_seconds {snapshot['uptime_seconds']:g}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """Writes snapshots of the metrics every `interval` seconds in a
+    background thread: `<path>.json` and `<path>.prom` (Prometheus
+    textfile). Files are replaced atomically.
+    """
+
+    def __init__(self, metrics, path, interval=10):
+        self.metrics = metrics
+        self.path = Path(path)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="tp-harvester-metrics", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        for suffix, content in (
+            (".json", self.metrics.to_json()),
+            (".prom", self.metrics.to_prometheus()),
+        ):
+            filename = self.path.with_name(self.path.name + suffix)
+            tmp_filename = filename.with_name(filename.name + ".tmp")
+            tmp_filename.write_text(content, encoding="utf-8")
+            tmp_filename.replace(filename)
+
+    def close(self):
+        """Stop and write a last snapshot."""
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Serve the metrics via HTTP in a background thread:
+    `/metrics` (Prometheus) and `/metrics.json`.
+    Returns the server (stop with `shutdown()`).
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.to_prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = metrics.to_json().encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="tp-harvester-metrics-http", daemon=True
+    )
+    thread.start()
+    return server
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _name(key):
+    name, labels = key
+    if not labels:
+        return name
+    labels = ",".join(f'{k}="{v}"' for k, v in labels)
+    return f"{name}{{{labels}}}"
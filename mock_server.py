@@ -0,0 +1,289 @@
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_LANGUAGES = {"de-de": "Deutschland", "de-at": "Österreich"}
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+COMPANY_PATTERN = "company{}.example"
+
+
+class MockTrustpilot:
+    """Local HTTP server with synthetic Trustpilot like data (no network).
+
+    Serves the start page (languages), a sitemap index per language
+    (`/index_<lang>.xml`), gzipped sub sitemaps with ETags (answered with
+    304 for conditional requests) and paginated review pages
+    (`/review/<company_key>?page=<n>`, 404 after the last page).
+    The locales overlap by half of their companies.
+
+    Failures are injected at random (`error_rates`, status -> share of
+    review page requests, e.g. `{500: 0.01, 403: 0.005}`). A share of
+    `redirect_rate` companies redirects to another url. `latency` seconds
+    are added to each response. Everything is reproducible by `seed`.
+    """
+
+    def __init__(
+        self,
+        languages=None,
+        n_companies=100,
+        n_sitemaps=4,
+        max_pages=5,
+        reviews_per_page=20,
+        padding=50_000,
+        latency=0.0,
+        error_rates=None,
+        redirect_rate=0.0,
+        seed=0,
+    ):
+        self.languages = languages or DEFAULT_LANGUAGES
+        self.n_companies = n_companies
+        self.n_sitemaps = n_sitemaps
+        self.max_pages = max_pages
+        self.reviews_per_page = reviews_per_page
+        self.padding = padding
+        self.latency = latency
+        self.error_rates = error_rates or {}
+        self.redirect_rate = redirect_rate
+        self.seed = seed
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.server = None
+        self.base_url = None
+
+    def serve(self, port=0, host="127.0.0.1"):
+        """Start the server in a background thread, returns its base url."""
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        thread = threading.Thread(
+            target=self.server.serve_forever, name="mock-trustpilot", daemon=True
+        )
+        thread.start()
+        return self.base_url
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def companies(self, lang_id):
+        """Company numbers listed in a locale"""
+        position = list(self.languages).index(lang_id)
+        start = position * (self.n_companies // 2)
+        return range(start, start + self.n_companies)
+
+    def n_pages(self, company):
+        return random.Random(self.seed * 1_000_003 + company).randint(
+            1, self.max_pages
+        )
+
+    def last_mod(self, company):
+        day = random.Random(self.seed * 7 + company).randint(1, 28)
+        return f"2024-07-{day:02d}"
+
+    def redirected(self, company):
+        rng = random.Random(self.seed * 13 + company)
+        return rng.random() < self.redirect_rate
+
+    def start_page(self):
+        items = "".join(
+            f'<li><button lang="{lang_id}"><span></span><span>{lang}</span>'
+            "</button></li>"
+            for lang_id, lang in self.languages.items()
+        )
+        return (
+            "<html><head></head><body><div><div><div><footer><div><div>"
+            f"<section><div><dl><div><dd><ul>{items}</ul></dd></div></dl>"
+            "</div></section></div></div></footer></div></div></div>"
+            "</body></html>"
+        ).encode("utf-8")
+
+    def sitemap_index(self, lang_id):
+        locs = "".join(
+            f"<sitemap><loc>{self.base_url}/sitemap_{lang_id}_{nr}.xml.gz</loc></sitemap>"
+            for nr in range(self.n_sitemaps)
+        )
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{SITEMAP_NS}">'
+            f"{locs}</sitemapindex>"
+        ).encode("utf-8")
+
+    def sitemap(self, lang_id, nr):
+        urls = "".join(
+            f"<url><loc>{self.base_url}/review/{COMPANY_PATTERN.format(company)}</loc>"
+            f"<lastmod>{self.last_mod(company)}</lastmod></url>"
+            for company in self.companies(lang_id)
+            if company % self.n_sitemaps == nr
+        )
+        xml = (
+            f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{SITEMAP_NS}">'
+            f"{urls}</urlset>"
+        )
+        return gzip.compress(xml.encode("utf-8"), mtime=0)
+
+    def review_page(self, company, page):
+        """HTML of a review page (jsonld in the head, `__NEXT_DATA__`)"""
+        company_key = COMPANY_PATTERN.format(company)
+        n_pages = self.n_pages(company)
+        n_reviews = n_pages * self.reviews_per_page
+        reviews = []
+        for nr in range(self.reviews_per_page):
+            # newest first: the review number grows with the age
+            age = (page - 1) * self.reviews_per_page + nr
+            reviews.append(
+                {
+                    "@type": "Review",
+                    "@id": f"https://www.trustpilot.com/#/schema/Review/{company_key}/{company}x{age}",
+                    "datePublished": time.strftime(
+                        "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(1722470400 - age * 3600)
+                    ),
+                    "headline": f"Review {age}",
+                    "reviewBody": "Lorem ipsum dolor sit amet. " * 10,
+                    "inLanguage": "de",
+                    "reviewRating": {"@type": "Rating", "ratingValue": str(age % 5 + 1)},
+                }
+            )
+        jsonld = {
+            "@context": "https://schema.org",
+            "@graph": [
+                {
+                    "@type": "LocalBusiness",
+                    "name": company_key,
+                    "aggregateRating": {
+                        "@type": "AggregateRating",
+                        "reviewCount": str(n_reviews),
+                    },
+                }
+            ]
+            + reviews,
+        }
+        next_data = {
+            "props": {
+                "pageProps": {
+                    "businessUnit": {
+                        "displayName": company_key,
+                        "numberOfReviews": n_reviews,
+                    },
+                    "filters": {
+                        "pagination": {"currentPage": page, "totalPages": n_pages}
+                    },
+                    "reviews": reviews,
+                    # stands in for the rest of the page data
+                    "translations": "x" * self.padding,
+                }
+            }
+        }
+        return (
+            "<html><head><title>Reviews</title>"
+            f'<script type="application/ld+json">{json.dumps(jsonld)}</script>'
+            "</head><body><div>reviews</div>"
+            f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(next_data)}</script>'
+            "</body></html>"
+        ).encode("utf-8")
+
+    def _injected_error(self):
+        with self._lock:
+            value = self._random.random()
+        for status, rate in self.error_rates.items():
+            if value < rate:
+                return status
+            value -= rate
+        return None
+
+    def _handle(self, handler):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(handler.path)
+        path = url.path
+        if path == "/":
+            return self._send(handler, 200, self.start_page())
+        if path.startswith("/index_") and path.endswith(".xml"):
+            lang_id = path[len("/index_") : -len(".xml")]
+            if lang_id in self.languages:
+                return self._send(
+                    handler, 200, self.sitemap_index(lang_id), "application/xml"
+                )
+        if path.startswith("/sitemap_") and path.endswith(".xml.gz"):
+            lang_id, nr = path[len("/sitemap_") : -len(".xml.gz")].rsplit("_", 1)
+            etag = f'"{self.seed}-{lang_id}-{nr}"'
+            if handler.headers.get("If-None-Match") == etag:
+                return self._send(handler, 304)
+            return self._send(
+                handler,
+                200,
+                self.sitemap(lang_id, int(nr)),
+                "application/x-gzip",
+                {"ETag": etag},
+            )
+        if path.startswith("/review/"):
+            return self._handle_review_page(handler, url)
+        self._send(handler, 404)
+
+    def _handle_review_page(self, handler, url):
+        company_key = url.path[len("/review/") :]
+        prefix, suffix = COMPANY_PATTERN.split("{}")
+        moved = company_key.endswith("-moved")
+        company_key = company_key.removesuffix("-moved")
+        try:
+            company = int(company_key[len(prefix) : len(company_key) - len(suffix)])
+        except ValueError:
+            return self._send(handler, 404)
+        if self.redirected(company) and not moved:
+            location = f"{self.base_url}{url.path}-moved"
+            if url.query:
+                location += f"?{url.query}"
+            return self._send(handler, 301, headers={"Location": location})
+        status = self._injected_error()
+        if status is not None:
+            return self._send(handler, status)
+        page = int(parse_qs(url.query).get("page", ["1"])[0])
+        if page > self.n_pages(company):
+            return self._send(handler, 404)
+        self._send(handler, 200, self.review_page(company, page))
+
+    def _send(self, handler, status, body=b"", content_type="text/html", headers=None):
+        with self._lock:
+            self.stats[status] += 1
+            self.stats["bytes"] += len(body)
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic Trustpilot data locally.")
+    parser.add_argument("--port", type=int, help="Port (default: 8000).", default=8000)
+    parser.add_argument("--n_companies", type=int, help="Companies per language.", default=100)
+    parser.add_argument("--max_pages", type=int, help="Most review pages of a company.", default=5)
+    parser.add_argument("--latency", type=float, help="Seconds added to each response.", default=0.0)
+    args = parser.parse_args()
+    mock = MockTrustpilot(
+        n_companies=args.n_companies, max_pages=args.max_pages, latency=args.latency
+    )
+    print(f"Serving on {mock.serve(args.port)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import scraper
+
+# response headers kept by a compact projection
+COMPACT_HEADERS = ("Date", "Last-Modified", "ETag", "Content-Type", "Content-Language")
+# fields of `__NEXT_DATA__` describing the company (the same on each page)
+COMPANY_PATHS = ("props.pageProps.businessUnit",)
+
+
+class Projection:
+    """Reduces the page data before it is stored.
+
+    `keep_paths` / `drop_paths` are dotted key paths into `__NEXT_DATA__`
+    (e.g. 'props.pageProps.reviews'), lists are projected element wise.
+    With `compact` the response headers are trimmed to `COMPACT_HEADERS`
+    and company level fields (`COMPANY_PATHS` and the jsonld nodes which
+    are no reviews) are only stored on the first page of a company.
+    """
+
+    def __init__(self, keep_paths=None, drop_paths=None, compact=False):
+        self.keep_paths = list(keep_paths or [])
+        self.drop_paths = list(drop_paths or [])
+        self.compact = compact
+        self._keep_tree = _path_tree(self.keep_paths) if self.keep_paths else None
+        self._drop_tree = _path_tree(self.drop_paths)
+        self._company_tree = _path_tree(COMPANY_PATHS)
+
+    def apply(self, page_infos, page):
+        """Projected `scraper.page_infos` of a page"""
+        jsonld = page_infos["jsonld"]
+        content = page_infos["structured_page_content"]
+        if content is not None:
+            if self._keep_tree is not None:
+                content = _keep(content, self._keep_tree)
+            content = _drop(content, self._drop_tree)
+            if self.compact and page > 1:
+                content = _drop(content, self._company_tree)
+        if self.compact and page > 1:
+            jsonld = [_reviews_only(jsonld_content) for jsonld_content in jsonld]
+        return dict(jsonld=jsonld, structured_page_content=content)
+
+    def headers(self, headers):
+        if not self.compact:
+            return dict(headers)
+        keep = {key.lower() for key in COMPACT_HEADERS}
+        return {key: value for key, value in headers.items() if key.lower() in keep}
+
+
+def projected_page_infos(content, projection=None, page=1):
+    """`scraper.page_infos` with an optional projection (picklable, e.g.
+    for a process pool) and the number of review pages of the company
+    (`total_pages`, taken before the projection)"""
+    infos = scraper.page_infos(content)
+    n_pages = scraper.total_pages(infos)
+    if projection is not None:
+        infos = projection.apply(infos, page)
+    infos["total_pages"] = n_pages
+    return infos
+
+
+def _path_tree(paths):
+    """Nested dict of the path keys, None marks the end of a path"""
+    tree = {}
+    for path in sorted(paths, key=lambda path: path.count(".")):
+        node = tree
+        *parents, last = path.split(".")
+        for key in parents:
+            if key in node and node[key] is None:
+                break  # a prefix of the path is selected completely
+            node = node.setdefault(key, {})
+        else:
+            node[last] = None
+    return tree
+
+
+def _keep(data, tree):
+    if tree is None:
+        return data
+    if isinstance(data, list):
+        return [_keep(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    return {key: _keep(data[key], subtree) for key, subtree in tree.items() if key in data}
+
+
+def _drop(data, tree):
+    if not tree:
+        return data
+    if isinstance(data, list):
+        return [_drop(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    projected = {}
+    for key, value in data.items():
+        if key not in tree:
+            projected[key] = value
+        elif tree[key] is not None:
+            projected[key] = _drop(value, tree[key])
+    return projected
+
+
+def _reviews_only(jsonld_content):
+    if not isinstance(jsonld_content, dict) or "@graph" not in jsonld_content:
+        return jsonld_content
+    graph = [node for node in jsonld_content["@graph"] if node.get("@type") == "Review"]
+    return jsonld_content | {"@graph": graph}
@@ -0,0 +1,666 @@
+import os
+import re
+import sys
+import json
+import zlib
+import logging
+import sqlite3
+import tarfile
+import argparse
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import scraper
+from writer import SHARD_PATTERN, WORKER_ID_PATTERN, decode_record
+
+logger = logging.getLogger(__name__)
+# output of a worker process (`<name>-worker-<worker_id>`)
+WORKER_SUFFIX_PATTERN = rf"(?:-worker-({WORKER_ID_PATTERN}))?"
+# outputs next to the pages of a harvest: reviews, replays and indexes
+OTHER_OUTPUT_PATTERN = re.compile(r"-reviews$|-replay|\.index\.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    format TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    company_key TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_company ON pages (company_key, page);
+CREATE INDEX IF NOT EXISTS pages_file ON pages (file_id, offset);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    compressed_offset INTEGER NOT NULL,
+    window BLOB NOT NULL,
+    PRIMARY KEY (file_id, offset)
+) WITHOUT ROWID;
+"""
+
+# deflate window: data a decompression started in the middle refers to
+WINDOW_SIZE = 2**15
+# end of the empty stored block written by a sync flush (after each page)
+SYNC_MARKER = b"\x00\x00\xff\xff"
+CHUNK_SIZE = 2**16
+# bytes decompressed to check a checkpoint
+VERIFY_SIZE = 512
+
+
+class HarvestReader:
+    """Random access to the pages of a harvest.
+
+    `paths` are tar.gz files (`writer.TarWriter`) and shard directories
+    (`writer.ShardWriter`), e.g. the parts of a resumed harvest (see
+    `harvest_paths`). The offsets of the pages are stored in an SQLite
+    index (`index_path`, default `<first path>.index.sqlite`), which is
+    built on first use and updated for new or changed files.
+
+    A tar.gz is one gzip stream: its index has checkpoints (every `span`
+    bytes of the tar) with the compressor window, taken at the sync
+    flushes after each page. A page is read by decompressing from the
+    checkpoint before it (at most `span` bytes), not from the start of
+    the file. Shards are indexed by their `.idx` sidecars.
+    """
+
+    def __init__(self, paths, index_path=None, span=2**20):
+        if isinstance(paths, (str, Path)):
+            paths = [paths]
+        self.paths = [Path(path) for path in paths]
+        if index_path is None:
+            index_path = f"{self.paths[0]}.index.sqlite"
+        self.index_path = Path(index_path)
+        self.span = span
+        self.connection = sqlite3.connect(str(self.index_path))
+        self.connection.executescript(SCHEMA)
+        # indexed files in the order of `paths`
+        self.file_ids = []
+        for path in self.paths:
+            if path.is_dir():
+                for shard in sorted(path.iterdir()):
+                    if SHARD_PATTERN.match(shard.name):
+                        self.file_ids.append(self._index_file(shard, "shard"))
+            else:
+                self.file_ids.append(self._index_file(path, "tar"))
+
+    def _index_file(self, path, file_format):
+        """Id of a file in the index, (re)indexed if it is new or changed."""
+        stat = path.stat()
+        row = self.connection.execute(
+            "SELECT file_id, size, mtime_ns FROM files WHERE path = ?",
+            (str(path.resolve()),),
+        ).fetchone()
+        if row is not None and row[1:] == (stat.st_size, stat.st_mtime_ns):
+            return row[0]
+        if file_format == "tar":
+            entries, checkpoints = _scan_tar(path, self.span)
+        else:
+            entries, checkpoints = _read_shard_index(path), []
+        with self.connection:
+            if row is not None:
+                for table in ("files", "pages", "checkpoints"):
+                    self.connection.execute(
+                        f"DELETE FROM {table} WHERE file_id = ?", (row[0],)
+                    )
+            cursor = self.connection.execute(
+                "INSERT INTO files (path, format, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                (str(path.resolve()), file_format, stat.st_size, stat.st_mtime_ns),
+            )
+            file_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?, ?, ?)",
+                (
+                    (company_key, page, file_id, offset, length)
+                    for company_key, page, offset, length in entries
+                ),
+            )
+            self.connection.executemany(
+                "INSERT INTO checkpoints VALUES (?, ?, ?, ?)",
+                (
+                    (file_id, offset, compressed_offset, zlib.compress(window))
+                    for offset, compressed_offset, window in checkpoints
+                ),
+            )
+        return file_id
+
+    def company_keys(self):
+        file_ids = self.file_ids
+        rows = self.connection.execute(
+            "SELECT DISTINCT company_key FROM pages "
+            f"WHERE file_id IN ({','.join('?' * len(file_ids))}) ORDER BY company_key",
+            file_ids,
+        )
+        return [company_key for (company_key,) in rows]
+
+    def n_pages(self):
+        file_ids = self.file_ids
+        (n,) = self.connection.execute(
+            "SELECT COUNT(*) FROM pages "
+            f"WHERE file_id IN ({','.join('?' * len(file_ids))})",
+            file_ids,
+        ).fetchone()
+        return n
+
+    def company_pages(self, company_key):
+        """Page data of a company by page number (a page stored in several
+        parts is taken from the last one)."""
+        pages = {}
+        for page, data in self._lookup(company_key):
+            pages[page] = data
+        return dict(sorted(pages.items()))
+
+    def page(self, company_key, page):
+        """Page data of a company page (None if it is not stored)."""
+        data = None
+        for _, data in self._lookup(company_key, page):
+            pass
+        return data
+
+    def _lookup(self, company_key, page=None):
+        sql = (
+            "SELECT page, file_id, offset, length FROM pages "
+            "WHERE company_key = ?"
+        )
+        params = (company_key,)
+        if page is not None:
+            sql += " AND page = ?"
+            params += (page,)
+        file_ids = self.file_ids
+        rows = [
+            row
+            for row in self.connection.execute(sql, params).fetchall()
+            if row[1] in file_ids
+        ]
+        rows.sort(key=lambda row: (file_ids.index(row[1]), row[2]))
+        for page, file_id, offset, length in rows:
+            yield page, _read_page(self.connection, file_id, offset, length)
+
+    def iter_pages(self, company_keys=None):
+        """Yields `(company_key, page, data)` of all pages (or the pages of
+        `company_keys`) file by file. Without `company_keys` the files are
+        read as a stream, otherwise only the pages of the companies."""
+        for file_id in self.file_ids:
+            yield from _iter_file(self.connection, file_id, company_keys)
+
+    def iter_reviews(self, company_keys=None):
+        """Yields the review records (see `scraper.review_records`) of the
+        pages, deduplicated by review id."""
+        yield from _unique_reviews(
+            record
+            for company_key, _, data in self.iter_pages(company_keys)
+            for record in scraper.review_records(data["jsonld"], company_key)
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+def harvest_paths(base_path, name):
+    """Tar.gz parts and shard directory of the harvest `name`
+    (e.g. '<date>-<lang>-trustpilot-reviews-jsonld') in session order,
+    followed by those of its workers (`<name>-worker-<worker_id>`).
+    Other files named like parts of the harvest are skipped with a
+    warning."""
+    base_path = Path(base_path)
+    pattern = re.compile(
+        rf"^{re.escape(name)}{WORKER_SUFFIX_PATTERN}(?:-([0-9]+))?(\.tar\.gz)?$"
+    )
+    parts = []
+    for path in base_path.iterdir():
+        match = pattern.match(path.name)
+        if match:
+            worker_id, part, tar = match.groups()
+            if tar or (part is None and path.is_dir()):
+                # a worker writes tar.gz parts or one shard directory
+                parts.append((worker_id or "", not tar, int(part or 1), path))
+                continue
+        if path.name.startswith(f"{name}-") and not OTHER_OUTPUT_PATTERN.search(path.name):
+            logger.warning(f"Skipped {path}: not a part of the harvest {name}.")
+    return [part[-1] for part in sorted(parts)]
+
+
+def stream_pages(paths):
+    """Yields `(company_key, page, data)` of the pages of tar.gz files and
+    shard directories as a stream (no index needed)."""
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    for path in map(Path, paths):
+        if not path.is_dir():
+            yield from _stream_tar(path)
+            continue
+        for shard in sorted(path.iterdir()):
+            if SHARD_PATTERN.match(shard.name):
+                compression = _shard_compression(shard)
+                with open(shard, "rb") as f:
+                    for company_key, page, offset, length in _read_shard_index(shard):
+                        f.seek(offset)
+                        yield company_key, page, decode_record(f.read(length), compression)
+
+
+def map_pages(
+    function,
+    paths,
+    n_workers=None,
+    company_keys=None,
+    index_path=None,
+    task_size=2**24,
+):
+    """Yields `function(company_key, page, data)` for the pages of a
+    harvest. The files (tar.gz parts and shards) are split into ranges of
+    about `task_size` bytes (by the offsets of the index, a tar range is
+    decompressed from its checkpoint), which are decoded in parallel by
+    `n_workers` processes (`function` has to be picklable). The results
+    are yielded in file order, at most `2 * n_workers` ranges are in
+    progress at once."""
+    reader = HarvestReader(paths, index_path)
+    connection = reader.connection
+    tasks = (
+        (reader.index_path, file_id, start, end, company_keys, function)
+        for file_id in reader.file_ids
+        for start, end in _page_ranges(connection, file_id, company_keys, task_size)
+    )
+    max_in_flight = 2 * (n_workers or os.cpu_count() or 1)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            in_flight = deque()
+            for task in tasks:
+                in_flight.append(executor.submit(_map_range, task))
+                if len(in_flight) >= max_in_flight:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+    finally:
+        reader.close()
+
+
+def iter_reviews_parallel(paths, n_workers=None, company_keys=None, index_path=None):
+    """`HarvestReader.iter_reviews` with the files decoded in parallel."""
+    yield from _unique_reviews(
+        record
+        for records in map_pages(
+            _page_reviews, paths, n_workers, company_keys, index_path
+        )
+        for record in records
+    )
+
+
+def _page_ranges(connection, file_id, company_keys, task_size):
+    """Offset ranges `(start, end)` of the pages of a file (of
+    `company_keys`), each spanning about `task_size` bytes"""
+    sql = "SELECT offset, length FROM pages WHERE file_id = ?"
+    params = (file_id,)
+    if company_keys is not None:
+        company_keys = list(company_keys)
+        sql += f" AND company_key IN ({','.join('?' * len(company_keys))})"
+        params += tuple(company_keys)
+    start = end = None
+    for offset, length in connection.execute(sql + " ORDER BY offset", params):
+        if start is not None and offset + length - start > task_size:
+            yield start, end
+            start = None
+        if start is None:
+            start = offset
+        end = offset + length
+    if start is not None:
+        yield start, end
+
+
+def _map_range(task):
+    """Applies a function to the pages of a file range (runs in the worker
+    processes)"""
+    index_path, file_id, start, end, company_keys, function = task
+    connection = sqlite3.connect(str(index_path))
+    try:
+        return [
+            function(company_key, page, data)
+            for company_key, page, data in _iter_range(
+                connection, file_id, start, end, company_keys
+            )
+        ]
+    finally:
+        connection.close()
+
+
+def _iter_range(connection, file_id, start, end, company_keys=None):
+    """Pages of a file with offsets in `start:end`. The range of a tar.gz
+    is decompressed once, from the checkpoint before `start`."""
+    path, file_format = connection.execute(
+        "SELECT path, format FROM files WHERE file_id = ?", (file_id,)
+    ).fetchone()
+    sql = (
+        "SELECT company_key, page, offset, length FROM pages "
+        "WHERE file_id = ? AND offset >= ? AND offset < ?"
+    )
+    params = (file_id, start, end)
+    if company_keys is not None:
+        company_keys = list(company_keys)
+        sql += f" AND company_key IN ({','.join('?' * len(company_keys))})"
+        params += tuple(company_keys)
+    rows = connection.execute(sql + " ORDER BY offset", params).fetchall()
+    with open(path, "rb") as f:
+        if file_format == "shard":
+            compression = _shard_compression(path)
+            for company_key, page, offset, length in rows:
+                f.seek(offset)
+                yield company_key, page, decode_record(f.read(length), compression)
+            return
+        checkpoint = connection.execute(
+            "SELECT offset, compressed_offset, window FROM checkpoints "
+            "WHERE file_id = ? AND offset <= ? ORDER BY offset DESC LIMIT 1",
+            (file_id, start),
+        ).fetchone()
+        data = _inflate_range(f, checkpoint, start, end - start)
+    for company_key, page, offset, length in rows:
+        yield company_key, page, json.loads(data[offset - start : offset - start + length])
+
+
+def _page_reviews(company_key, page, data):
+    return scraper.review_records(data["jsonld"], company_key)
+
+
+def _unique_reviews(records):
+    review_ids = set()
+    for record in records:
+        review_id = record["id"]
+        if review_id is not None:
+            if review_id in review_ids:
+                continue
+            review_ids.add(review_id)
+        yield record
+
+
+def _iter_file(connection, file_id, company_keys=None):
+    path, file_format = connection.execute(
+        "SELECT path, format FROM files WHERE file_id = ?", (file_id,)
+    ).fetchone()
+    if company_keys is not None:
+        company_keys = list(company_keys)
+        rows = connection.execute(
+            "SELECT company_key, page, offset, length FROM pages "
+            f"WHERE file_id = ? AND company_key IN ({','.join('?' * len(company_keys))}) "
+            "ORDER BY offset",
+            (file_id, *company_keys),
+        ).fetchall()
+        for company_key, page, offset, length in rows:
+            yield company_key, page, _read_page(connection, file_id, offset, length)
+    elif file_format == "tar":
+        yield from _stream_tar(path)
+    else:
+        rows = connection.execute(
+            "SELECT company_key, page, offset, length FROM pages "
+            "WHERE file_id = ? ORDER BY offset",
+            (file_id,),
+        )
+        compression = _shard_compression(path)
+        with open(path, "rb") as f:
+            for company_key, page, offset, length in rows:
+                f.seek(offset)
+                yield company_key, page, decode_record(f.read(length), compression)
+
+
+def _read_page(connection, file_id, offset, length):
+    path, file_format = connection.execute(
+        "SELECT path, format FROM files WHERE file_id = ?", (file_id,)
+    ).fetchone()
+    with open(path, "rb") as f:
+        if file_format == "shard":
+            f.seek(offset)
+            return decode_record(f.read(length), _shard_compression(path))
+        checkpoint = connection.execute(
+            "SELECT offset, compressed_offset, window FROM checkpoints "
+            "WHERE file_id = ? AND offset <= ? ORDER BY offset DESC LIMIT 1",
+            (file_id, offset),
+        ).fetchone()
+        return json.loads(_inflate_range(f, checkpoint, offset, length))
+
+
+def _inflate_range(f, checkpoint, offset, length):
+    """Bytes `offset:offset + length` of the tar in a gzip file,
+    decompressed from a checkpoint before `offset`."""
+    checkpoint_offset, compressed_offset, window = checkpoint
+    window = zlib.decompress(window)
+    if window:
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+    else:
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    f.seek(compressed_offset)
+    skip = offset - checkpoint_offset
+    data = bytearray()
+    chunk = b""
+    while len(data) < length:
+        if not chunk:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise EOFError(f"{f.name} ends before offset {offset + length}.")
+        # no more output than needed (the data may be highly compressed)
+        output = inflater.decompress(chunk, skip + length - len(data))
+        chunk = inflater.unconsumed_tail
+        if skip:
+            n_skipped = min(skip, len(output))
+            output = output[n_skipped:]
+            skip -= n_skipped
+        data += output
+    return bytes(data)
+
+
+def _stream_tar(path):
+    """Pages of a tar.gz as a stream (up to the last complete page of a
+    killed run)."""
+    try:
+        with tarfile.open(path, "r|gz") as tar:
+            for member in tar:
+                key = _page_key(member)
+                if key is None:
+                    continue
+                data = json.loads(tar.extractfile(member).read())
+                yield *key, data
+    except (EOFError, zlib.error, tarfile.ReadError):
+        pass
+
+
+def _page_key(member):
+    """`(company_key, page)` of a tar member `<company_key>/<page>.json`"""
+    if not member.isfile():
+        return None
+    company_key, _, filename = member.name.rpartition("/")
+    page = filename.removesuffix(".json")
+    if not company_key or not page.isdigit():
+        return None
+    return company_key, int(page)
+
+
+def _scan_tar(path, span):
+    """Page entries `(company_key, page, offset, length)` (offsets in the
+    tar) and checkpoints `(offset, compressed_offset, window)` of a
+    tar.gz."""
+    entries = []
+    with open(path, "rb") as f:
+        inflater = _IndexingInflater(f, span)
+        try:
+            with tarfile.open(fileobj=inflater, mode="r|") as tar:
+                for member in tar:
+                    key = _page_key(member)
+                    if key is not None:
+                        entries.append((*key, member.offset_data, member.size))
+        except (EOFError, zlib.error, tarfile.ReadError):
+            pass  # truncated by a killed run
+    # only complete pages
+    entries = [entry for entry in entries if entry[2] + entry[3] <= inflater.position]
+    return entries, inflater.checkpoints
+
+
+class _IndexingInflater:
+    """File like object reading the tar of a gzip file and recording
+    checkpoints to start the decompression from.
+
+    A checkpoint is a position after a sync flush (the stream is byte
+    aligned and a new deflate block starts) with the last `WINDOW_SIZE`
+    bytes of output before it. Sync flushes are found by their marker,
+    each candidate is checked by decompressing from it.
+    """
+
+    def __init__(self, f, span):
+        self.f = f
+        self.span = span
+        self.position = 0
+        self.compressed_position = _gzip_header_length(f)
+        f.seek(self.compressed_position)
+        self.checkpoints = [(0, self.compressed_position, b"")]
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._window = b""
+        self._buffer = bytearray()
+        self._candidate = None
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _fill(self):
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return
+        start = 0
+        while not self._eof:
+            end = chunk.find(SYNC_MARKER, start)
+            if end < 0:
+                self._inflate(chunk[start:])
+                break
+            self._inflate(chunk[start : end + len(SYNC_MARKER)])
+            start = end + len(SYNC_MARKER)
+            if (
+                self._candidate is None
+                and self.position - self.checkpoints[-1][0] >= self.span
+            ):
+                self._candidate = (self.position, self.compressed_position, self._window, b"")
+        if self._eof:
+            self._check_candidate()
+
+    def _inflate(self, data):
+        output = self._inflater.decompress(data)
+        self.compressed_position += len(data)
+        if self._inflater.eof:
+            self._eof = True
+        if not output:
+            return
+        self._buffer += output
+        self.position += len(output)
+        self._window = (self._window + output)[-WINDOW_SIZE:]
+        if self._candidate is not None:
+            offset, compressed_offset, window, expected = self._candidate
+            expected += output[: VERIFY_SIZE - len(expected)]
+            self._candidate = (offset, compressed_offset, window, expected)
+            self._check_candidate()
+
+    def _check_candidate(self):
+        if self._candidate is None:
+            return
+        offset, compressed_offset, window, expected = self._candidate
+        if len(expected) < VERIFY_SIZE and not self._eof:
+            return
+        self._candidate = None
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+        position = self.f.tell()
+        self.f.seek(compressed_offset)
+        try:
+            output = inflater.decompress(self.f.read(CHUNK_SIZE), len(expected))
+        except zlib.error:
+            return  # the marker was part of the compressed data
+        finally:
+            self.f.seek(position)
+        if output == expected:
+            self.checkpoints.append((offset, compressed_offset, window))
+
+
+def _gzip_header_length(f):
+    """Length of the gzip header at the start of a file (RFC 1952)"""
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:2] != b"\x1f\x8b":
+        raise tarfile.ReadError(f"{f.name} is not a gzip file.")
+    flags = header[3]
+    length = 10
+    if flags & 4:  # FEXTRA
+        f.seek(length)
+        length += 2 + int.from_bytes(f.read(2), "little")
+    for flag in (8, 16):  # FNAME, FCOMMENT: zero terminated
+        if flags & flag:
+            f.seek(length)
+            while True:
+                byte = f.read(1)
+                length += 1
+                if byte in (b"\x00", b""):
+                    break
+    if flags & 2:  # FHCRC
+        length += 2
+    return length
+
+
+def _read_shard_index(path):
+    entries = []
+    with open(f"{path}.idx", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 4:
+                break  # incomplete last line of a killed run
+            company_key, page, offset, length = fields
+            entries.append((company_key, int(page), int(offset), int(length)))
+    return entries
+
+
+def _shard_compression(path):
+    return "gzip" if str(path).endswith(".gz") else "zstd"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Read pages or reviews of a harvest (tar.gz parts or shard directories) as JSON lines."
+    )
+    parser.add_argument("paths", type=str, nargs="+", help="The tar.gz files and shard directories of a harvest.")
+    parser.add_argument("--company_key", type=str, help="Only these companies, separated by comma (read by the index).", default=None)
+    parser.add_argument("--reviews", action="store_true", help="Write the review records instead of the pages.")
+    parser.add_argument("--index_path", type=str, help="The index file (default: <first path>.index.sqlite).", default=None)
+    parser.add_argument("--n_parse_workers", type=int, help="Number of decoding processes (default: decode in this process).", default=None)
+    args = parser.parse_args()
+    company_keys = None if args.company_key is None else args.company_key.split(",")
+    if args.reviews:
+        if args.n_parse_workers:
+            records = iter_reviews_parallel(
+                args.paths, args.n_parse_workers, company_keys, args.index_path
+            )
+        else:
+            records = HarvestReader(args.paths, args.index_path).iter_reviews(company_keys)
+    else:
+        if args.n_parse_workers:
+            records = map_pages(
+                _page_record, args.paths, args.n_parse_workers, company_keys, args.index_path
+            )
+        else:
+            records = (
+                _page_record(*page)
+                for page in HarvestReader(args.paths, args.index_path).iter_pages(company_keys)
+            )
+    for record in records:
+        sys.stdout.write(json.dumps(record) + "\n")
+
+
+def _page_record(company_key, page, data):
+    return dict(company_key=company_key, page=page, data=data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import time
+import heapq
+import random
+from array import array
+
+from loader import company_key_from_url
+
+PRIORITIES = ("random", "last_mod", "reviews")
+
+
+def prioritize(url_infos, priority="random", page_counts=None, limit=None):
+    """Company url infos (a sequence, e.g. `CompanyColumns`) ordered by
+    priority (most valuable first), the first `limit` as `CompanyColumns`.
+    Only the indices are sorted, the url infos are not held as dicts.
+
+    Priorities:
+     * "random": random order
+     * "last_mod": most recently modified companies first (sitemap)
+     * "reviews": companies with the most known reviews first (pages
+       harvested before, see `checkpoint.CheckpointStore.page_counts`),
+       ties by `last_mod`
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority}. Use one of {PRIORITIES}")
+    order = list(range(len(url_infos)))
+    random.shuffle(order)
+    if priority == "last_mod":
+        order.sort(key=lambda index: url_infos[index]["last_mod"] or "", reverse=True)
+    elif priority == "reviews":
+        page_counts = page_counts or {}
+
+        def key(index):
+            url_info = url_infos[index]
+            return (
+                page_counts.get(company_key_from_url(url_info["url"]), 0),
+                url_info["last_mod"] or "",
+            )
+
+        order.sort(key=key, reverse=True)
+    return CompanyColumns(url_infos[index] for index in order[:limit])
+
+
+class CompanyColumns:
+    """Company url infos (`url`, `last_mod`, first `page` due, default 1)
+    of a language in compact columns.
+
+    Urls are stored as company keys (utf-8, one buffer with offsets)
+    after the url prefix of the language, other urls as exceptions. The
+    `last_mod` values are interned (a column of codes), the pages are a
+    column of ints. A company costs about 40 bytes instead of some hundred
+    for a dict. Items are url info dicts created on access.
+    """
+
+    def __init__(self, url_infos=()):
+        self.url_prefix = None
+        self._keys = bytearray()
+        self._offsets = array("Q", [0])
+        self._last_mods = []
+        self._last_mod_codes = {}
+        self._last_mod_column = array("I")
+        self._pages = array("I")
+        self._other_urls = {}
+        for url_info in url_infos:
+            self.append(url_info)
+
+    def append(self, url_info):
+        url = url_info["url"]
+        company_key = company_key_from_url(url)
+        if self.url_prefix is None:
+            self.url_prefix = url[: len(url) - len(company_key)]
+        if url != self.url_prefix + company_key:
+            self._other_urls[len(self)] = url
+        self._keys += company_key.encode("utf-8")
+        self._offsets.append(len(self._keys))
+        last_mod = url_info["last_mod"]
+        code = self._last_mod_codes.get(last_mod)
+        if code is None:
+            code = self._last_mod_codes[last_mod] = len(self._last_mods)
+            self._last_mods.append(last_mod)
+        self._last_mod_column.append(code)
+        self._pages.append(url_info.get("page", 1))
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        url = self._other_urls.get(index)
+        if url is None:
+            start, end = self._offsets[index], self._offsets[index + 1]
+            url = self.url_prefix + self._keys[start:end].decode("utf-8")
+        return dict(
+            url=url,
+            last_mod=self._last_mods[self._last_mod_column[index]],
+            page=self._pages[index],
+        )
+
+
+class FairShareScheduler:
+    """Queue like frontier (`get`, `put`, `empty`, `qsize`, `task_done`)
+    over the companies of several languages.
+
+    Requests are shared between the languages with pending pages by their
+    weights (stride scheduling): a language with weight 2 gets twice the
+    requests of a language with weight 1. Within a language the pages are
+    served by the `rank` of their company (lower first, see `prioritize`),
+    next pages of a company keep its rank.
+    The companies of a language are added in rank order (`add_companies`)
+    and kept as `CompanyColumns`; only the next pages put for companies
+    in progress are queued (as rank and page). Url infos served have the
+    keys `language_id` and `rank`. `n_started` counts the companies
+    served.
+    """
+
+    def __init__(self, weights):
+        for language_id, weight in weights.items():
+            if weight <= 0:
+                raise ValueError(f"Weight of {language_id} has to be positive.")
+        self.weights = dict(weights)
+        self._companies = {language_id: CompanyColumns() for language_id in weights}
+        self._cursors = {language_id: 0 for language_id in weights}
+        self._heaps = {language_id: [] for language_id in weights}
+        self._passes = {language_id: 0.0 for language_id in weights}
+        self._pass_now = 0.0
+        self._size = 0
+        self.n_started = 0
+
+    def add_companies(self, language_id, url_infos):
+        """Queue the companies of a language (url infos in rank order)."""
+        self._wake(language_id)
+        companies = self._companies[language_id]
+        n_companies = len(companies)
+        for url_info in url_infos:
+            companies.append(url_info)
+        self._size += len(companies) - n_companies
+
+    def put(self, url_info):
+        """Queue a (next) page of a company added before."""
+        language_id = url_info["language_id"]
+        self._wake(language_id)
+        heapq.heappush(self._heaps[language_id], (url_info["rank"], url_info["page"]))
+        self._size += 1
+
+    def _wake(self, language_id):
+        if not self._n_pending(language_id):
+            # an idle language does not get the requests it missed
+            self._passes[language_id] = max(self._passes[language_id], self._pass_now)
+
+    def _n_pending(self, language_id):
+        return (
+            len(self._companies[language_id])
+            - self._cursors[language_id]
+            + len(self._heaps[language_id])
+        )
+
+    def get(self):
+        language_id = min(
+            (language_id for language_id in self.weights if self._n_pending(language_id)),
+            key=self._passes.__getitem__,
+        )
+        self._pass_now = self._passes[language_id]
+        self._passes[language_id] += 1 / self.weights[language_id]
+        self._size -= 1
+        companies = self._companies[language_id]
+        heap = self._heaps[language_id]
+        cursor = self._cursors[language_id]
+        if heap and (cursor == len(companies) or heap[0][0] < cursor):
+            rank, page = heapq.heappop(heap)
+            url_info = companies[rank] | dict(page=page)
+        else:
+            rank = cursor
+            self._cursors[language_id] += 1
+            self.n_started += 1
+            url_info = companies[rank]
+        return url_info | dict(language_id=language_id, rank=rank)
+
+    def empty(self):
+        return self._size == 0
+
+    def qsize(self):
+        return self._size
+
+    def qsize_by_language(self):
+        return {language_id: self._n_pending(language_id) for language_id in self.weights}
+
+    def task_done(self):
+        pass
+
+    def holds(self, url_info, seconds=0):
+        """Companies are not leased (see `work_queue.LeasedFrontier`)."""
+        return True
+
+
+class RetryQueue:
+    """Pages whose request failed temporarily, due again after a delay.
+
+    `put` defers a url info by `delay` seconds, `pop_due` returns the
+    earliest url info which is due (with its number of failed attempts)
+    or None. The harvest takes due retries before new pages of the
+    frontier and keeps fetching other pages while retries wait.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._n_put = 0
+
+    def put(self, url_info, attempt, delay):
+        self._n_put += 1
+        heapq.heappush(
+            self._heap, (time.monotonic() + delay, self._n_put, attempt, url_info)
+        )
+
+    def pop_due(self):
+        if not self._heap or self._heap[0][0] > time.monotonic():
+            return None
+        _, _, attempt, url_info = heapq.heappop(self._heap)
+        return url_info, attempt
+
+    def wait_time(self):
+        """Seconds until the next retry is due (None if there is none)."""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def __len__(self):
+        return len(self._heap)
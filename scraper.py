@@ -1,5 +1,8 @@
+import re
 import json
 
+import lxml.html
+
 XPATH_LANGUAGES = (
     "/html/body/div[1]/div/div/footer/div/div/section[1]/div/dl/div/dd/ul/li"
 )
@@ -43,3 +46,132 @@ def structured_content_data(tree):
         json_content = json.loads(json_content_raw)
     return json_content
 
+
+
+# fast path: find the script payloads in the raw html without a DOM
+JSONLD_START = re.compile(
+    rb"""<script[^>]*\stype=["']application/ld\+json["'][^>]*>""", re.I
+)
+STRUCTURED_CONTENT_START = re.compile(
+    rb"""<script[^>]*\sid=["']__NEXT_DATA__["'][^>]*>""", re.I
+)
+SCRIPT_END = re.compile(rb"</script\s*>", re.I)
+HEAD_END = re.compile(rb"</head\s*>", re.I)
+
+
+def page_infos(content):
+    """jsonld and __NEXT_DATA__ of a review page (raw html bytes).
+    The payloads are found by scanning the bytes. The lxml DOM is only
+    built if the fast path fails (e.g. missing </head>, invalid json).
+    """
+    try:
+        return dict(
+            jsonld=jsonld_from_bytes(content),
+            structured_page_content=structured_content_data_from_bytes(content),
+        )
+    except ValueError:
+        tree = lxml.html.fromstring(content)
+        return dict(
+            jsonld=jsonld(tree),
+            structured_page_content=structured_content_data(tree),
+        )
+
+
+def jsonld_from_bytes(content):
+    """`jsonld` for raw html bytes (scripts in the html head only)"""
+    head_end = HEAD_END.search(content)
+    if head_end is None:
+        raise ValueError("No end of html head found.")
+    head = content[: head_end.start()]
+    return [json.loads(payload) for payload in _script_payloads(head, JSONLD_START)]
+
+
+def structured_content_data_from_bytes(content):
+    """`structured_content_data` for raw html bytes"""
+    payloads = _script_payloads(content, STRUCTURED_CONTENT_START)
+    json_content = None
+    for payload in payloads:
+        if json_content is not None:
+            raise ValueError("More than one __NEXT_DATA__ element found.")
+        json_content = json.loads(payload)
+    return json_content
+
+
+def _script_payloads(content, start_pattern):
+    for start in start_pattern.finditer(content):
+        end = SCRIPT_END.search(content, start.end())
+        if end is None:
+            raise ValueError("Script element is not closed.")
+        yield content[start.end() : end.start()]
+
+
+def reviews(json_ld_contents):
+    """All review objects (@type 'Review') in the jsonld contents of a page"""
+    found = []
+
+    def _walk(obj):
+        if isinstance(obj, dict):
+            if obj.get("@type") == "Review":
+                found.append(obj)
+                return
+            for value in obj.values():
+                _walk(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                _walk(value)
+
+    _walk(json_ld_contents)
+    return found
+
+
+def review_dates(json_ld_contents):
+    """Publishing dates (ISO format) of all reviews of a page"""
+    dates = [review.get("datePublished") for review in reviews(json_ld_contents)]
+    return [date for date in dates if date]
+
+
+def review_records(json_ld_contents, company_key):
+    """One flat record for each review of a page"""
+    records = []
+    for review in reviews(json_ld_contents):
+        rating = (review.get("reviewRating") or {}).get("ratingValue")
+        try:
+            rating = int(rating)
+        except (TypeError, ValueError):
+            pass
+        records.append(
+            dict(
+                id=review_id(review),
+                company_key=company_key,
+                rating=rating,
+                date=review.get("datePublished"),
+                language=review.get("inLanguage"),
+                text=review.get("reviewBody"),
+            )
+        )
+    return records
+
+
+REVIEWS_PER_PAGE = 20
+
+
+def total_pages(page_infos):
+    """Number of review pages of a company (None if unknown).
+    Only the pagination of `__NEXT_DATA__` is used: a count estimated from
+    the reviews (`numberOfReviews`, `aggregateRating`) may miss listed
+    pages, so the paging has to probe for the 404 then.
+    """
+    content = page_infos.get("structured_page_content") or {}
+    page_props = (content.get("props") or {}).get("pageProps") or {}
+    pagination = (page_props.get("filters") or {}).get("pagination") or {}
+    if isinstance(pagination.get("totalPages"), int):
+        return max(pagination["totalPages"], 1)
+    return None
+
+
+def review_id(review):
+    """Id of a review object (last part of its '@id')"""
+    review_url = review.get("@id")
+    if not review_url:
+        return None
+    return review_url.rstrip("/").rsplit("/", 1)[-1]
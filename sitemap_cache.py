@@ -0,0 +1,53 @@
+import gzip
+import json
+import hashlib
+from pathlib import Path
+
+
+class SitemapCache:
+    """Company urls of sub sitemaps with their HTTP validators on disk.
+
+    Used for conditional requests (`If-None-Match`/`If-Modified-Since`):
+    if the server answers 304, the company urls of the last download are
+    reused instead of downloading and parsing the sitemap again.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def _filename(self, sitemap_url):
+        key = hashlib.sha1(sitemap_url.encode("utf-8")).hexdigest()
+        return self.path / f"{key}.json.gz"
+
+    def get(self, sitemap_url):
+        filename = self._filename(sitemap_url)
+        if not filename.exists():
+            return None
+        with gzip.open(filename, "rt", encoding="utf-8") as f:
+            return json.load(f)
+
+    def put(self, sitemap_url, headers, company_urls):
+        entry = dict(
+            url=sitemap_url,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            company_urls=company_urls,
+        )
+        self.path.mkdir(parents=True, exist_ok=True)
+        filename = self._filename(sitemap_url)
+        tmp_filename = filename.with_suffix(".tmp")
+        with gzip.open(tmp_filename, "wt", encoding="utf-8") as f:
+            json.dump(entry, f)
+        tmp_filename.replace(filename)
+
+
+def conditional_headers(entry):
+    """Request headers for a conditional GET of a cached sitemap"""
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
@@ -0,0 +1,199 @@
+import sqlite3
+from collections.abc import Mapping
+from pathlib import Path
+
+from loader import company_key_from_url
+
+SCHEMA = """
+CREATE TABLE languages (
+    lang_id TEXT PRIMARY KEY,
+    lang TEXT,
+    position INTEGER NOT NULL,
+    n_companies INTEGER NOT NULL,
+    url_prefix TEXT
+);
+CREATE TABLE company_urls (
+    lang_id TEXT NOT NULL,
+    company_key TEXT NOT NULL,
+    last_mod TEXT,
+    url TEXT,
+    PRIMARY KEY (lang_id, company_key)
+) WITHOUT ROWID;
+"""
+# created after the bulk insert (faster)
+INDEXES = """
+CREATE INDEX company_urls_last_mod ON company_urls (lang_id, last_mod);
+"""
+
+
+class SitemapStore:
+    """Indexed snapshot of the sitemap infos (SQLite).
+
+    Company urls are stored per language as company key and last_mod. The
+    url is only stored if it differs from the url prefix of the language
+    (`<prefix><company_key>`). Languages can be loaded one at a time and
+    queried by company key and last_mod range without loading the rest.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(
+            f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    @classmethod
+    def create(
+        cls, path, available_languages, language_overview, language_company_urls
+    ):
+        """Write a new snapshot (atomically replaces an existing one)."""
+        path = Path(path)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.unlink(missing_ok=True)
+        connection = sqlite3.connect(str(tmp_path))
+        connection.executescript(SCHEMA)
+        with connection:
+            for position, info in enumerate(language_overview):
+                lang_id = info["lang_id"]
+                company_urls = language_company_urls[lang_id]
+                url_prefix = _url_prefix(company_urls)
+                connection.execute(
+                    "INSERT INTO languages VALUES (?, ?, ?, ?, ?)",
+                    (
+                        lang_id,
+                        available_languages.get(lang_id, info.get("lang")),
+                        position,
+                        info["n_companies"],
+                        url_prefix,
+                    ),
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO company_urls VALUES (?, ?, ?, ?)",
+                    (
+                        _company_url_row(lang_id, url_prefix, url_info)
+                        for url_info in company_urls
+                    ),
+                )
+            connection.executescript(INDEXES)
+        connection.close()
+        tmp_path.replace(path)
+        return cls(path)
+
+    def available_languages(self):
+        rows = self.connection.execute(
+            "SELECT lang_id, lang FROM languages ORDER BY position"
+        )
+        return dict(rows)
+
+    def language_overview(self):
+        rows = self.connection.execute(
+            "SELECT lang_id, lang, n_companies FROM languages ORDER BY position"
+        )
+        return [
+            dict(lang_id=lang_id, lang=lang, n_companies=n_companies)
+            for lang_id, lang, n_companies in rows
+        ]
+
+    def company_urls(self, lang_id, last_mod_from=None, last_mod_to=None):
+        """Company url infos of a language, optionally filtered by a
+        last_mod range (inclusive, ISO dates)."""
+        return list(self.iter_company_urls(lang_id, last_mod_from, last_mod_to))
+
+    def iter_company_urls(self, lang_id, last_mod_from=None, last_mod_to=None):
+        """`company_urls` as a stream (one url info at a time)."""
+        url_prefix = self._url_prefix(lang_id)
+        sql = (
+            "SELECT company_key, last_mod, url FROM company_urls "
+            "WHERE lang_id = ?"
+        )
+        params = [lang_id]
+        if last_mod_from is not None:
+            sql += " AND last_mod >= ?"
+            params.append(last_mod_from)
+        if last_mod_to is not None:
+            sql += " AND last_mod <= ?"
+            params.append(last_mod_to)
+        for row in self.connection.execute(sql, params):
+            yield _url_info(url_prefix, *row)
+
+    def company_url(self, lang_id, company_key):
+        """Url info of one company (None if not listed)"""
+        row = self.connection.execute(
+            "SELECT company_key, last_mod, url FROM company_urls "
+            "WHERE lang_id = ? AND company_key = ?",
+            (lang_id, company_key),
+        ).fetchone()
+        if row is None:
+            return None
+        return _url_info(self._url_prefix(lang_id), *row)
+
+    def _url_prefix(self, lang_id):
+        row = self.connection.execute(
+            "SELECT url_prefix FROM languages WHERE lang_id = ?", (lang_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(lang_id)
+        return row[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class LanguageCompanyUrls(Mapping):
+    """Read only mapping language id -> company url infos of a store.
+    Languages are loaded on access. The last `cache_size` languages are
+    kept in memory.
+    """
+
+    def __init__(self, store, cache_size=1):
+        self.store = store
+        self.cache_size = cache_size
+        self._lang_ids = list(store.available_languages())
+        self._cache = {}
+
+    def __getitem__(self, lang_id):
+        if lang_id in self._cache:
+            return self._cache[lang_id]
+        if lang_id not in self._lang_ids:
+            raise KeyError(lang_id)
+        company_urls = self.store.company_urls(lang_id)
+        while self._cache and len(self._cache) >= self.cache_size:
+            del self._cache[next(iter(self._cache))]
+        if self.cache_size > 0:
+            self._cache[lang_id] = company_urls
+        return company_urls
+
+    def stream(self, lang_id):
+        """Company url infos of a language one at a time (from the cache
+        or the store, not cached: e.g. to build a frontier)."""
+        if lang_id in self._cache:
+            return iter(self._cache[lang_id])
+        if lang_id not in self._lang_ids:
+            raise KeyError(lang_id)
+        return self.store.iter_company_urls(lang_id)
+
+    def __iter__(self):
+        return iter(self._lang_ids)
+
+    def __len__(self):
+        return len(self._lang_ids)
+
+
+def _url_prefix(company_urls):
+    if not company_urls:
+        return None
+    url = company_urls[0]["url"]
+    return url[: len(url) - len(company_key_from_url(url))]
+
+
+def _company_url_row(lang_id, url_prefix, url_info):
+    url = url_info["url"]
+    company_key = company_key_from_url(url)
+    if url_prefix is not None and url == url_prefix + company_key:
+        url = None
+    return lang_id, company_key, url_info["last_mod"], url
+
+
+def _url_info(url_prefix, company_key, last_mod, url):
+    if url is None:
+        url = url_prefix + company_key
+    return dict(url=url, last_mod=last_mod)
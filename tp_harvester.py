@@ -3,12 +3,20 @@ import json
 import time
 import datetime
 import tarfile
+import gzip
 import io
-import random
 import argparse
 import logging
-import queue
 from collections import defaultdict
+from functools import partial
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+    FIRST_COMPLETED,
+)
 
 from glob import glob
 from pathlib import Path
@@ -18,12 +26,27 @@ import requests
 import lxml
 import lxml.html
 
-from tenacity import RetryError
 from tqdm import tqdm
 from requests.exceptions import HTTPError
 
 import loader
 import scraper
+import sitemap_cache
+from archive import ResponseArchive
+from canonical import DEDUP_MODES, assign_locales, canonical_company_key
+from checkpoint import CheckpointStore
+from metrics import Metrics, MetricsReporter, serve_metrics
+from projection import Projection, projected_page_infos
+from scheduler import (
+    PRIORITIES,
+    CompanyColumns,
+    FairShareScheduler,
+    RetryQueue,
+    prioritize,
+)
+from sitemap_store import SitemapStore, LanguageCompanyUrls
+from work_queue import LeasedFrontier, WorkQueue
+from writer import COMPRESSIONS, OUTPUT_FORMATS, WORKER_ID_PATTERN, open_writer
 
 
 class TPCollector:
@@ -39,21 +62,66 @@ class TPCollector:
                 "From": mail,
             }
         )
-        self.retry_attempts = 3
-        self.retry_wait = 1  # second
+        # tries of a page; failed pages are retried later (see _fetch_pages)
+        self.retry_attempts = 5
+        self.retry_wait = 1  # second, doubled with each try
+        self.max_retry_wait = 300
         self.timeout = 5
-        self.max_calls_per_minute = 60
+        # start rate; adapted between min and max by the server responses
+        self.calls_per_minute = 60
+        self.max_calls_per_minute = 240
+        self.min_calls_per_minute = 6
+        # latencies, status codes, bytes, queue sizes (see metrics.Metrics)
+        self.metrics = Metrics()
+        # reduces the stored page data (see projection.Projection)
+        self.projection = None
+        # queue the pages of a company ahead once their number is known
+        # (opt-in: many pages at once may be throttled with 403)
+        self.predictive_pagination = False
+        # pages of a company queued at once with predictive pagination
+        self.pages_ahead = 3
 
+        self.rate_limiter = loader.RateLimiter(
+            self.calls_per_minute,
+            max_calls_per_minute=self.max_calls_per_minute,
+            min_calls_per_minute=self.min_calls_per_minute,
+            logger=self.logger,
+        )
+        # pauses the harvest if the error rate of the host spikes
+        self.circuit_breaker = loader.CircuitBreaker(logger=self.logger)
+        # no blocking retries: failed pages are deferred by _fetch_pages
         self._get_response = loader.get_function_get_response(
+            self.session,
+            1,
+            self.retry_wait,
+            self.timeout,
+            self.rate_limiter,
+            self.logger,
+            metrics=self.metrics,
+            breaker=self.circuit_breaker,
+        )
+        # sitemaps are served by a separate host for crawlers
+        self.sitemap_calls_per_minute = 600
+        self.n_sitemap_workers = 8
+        self.sitemap_rate_limiter = loader.RateLimiter(
+            self.sitemap_calls_per_minute,
+            min_calls_per_minute=self.min_calls_per_minute,
+            logger=self.logger,
+        )
+        self._get_sitemap_response = loader.get_function_get_response(
             self.session,
             self.retry_attempts,
             self.retry_wait,
             self.timeout,
-            self.max_calls_per_minute,
+            self.sitemap_rate_limiter,
             self.logger,
         )
         self.language_overview = None
+        self.sitemap_store = None
         self.path_page_map_infos = Path(path_page_map_infos)
+        self.sitemap_cache = sitemap_cache.SitemapCache(
+            self.path_page_map_infos / "sitemap_cache"
+        )
         self.load_page_map_infos()
 
     def setup(self):
@@ -68,9 +136,22 @@ class TPCollector:
             self.language_company_urls,
         ) = _
         self._persist_page_map_infos()
+        # load company urls lazily from the store from now on
+        self.language_company_urls = LanguageCompanyUrls(self.sitemap_store)
 
     def _get_languages(self):
-        resp = self._get_response(self.url_start_page)
+        for attempt in range(1, self.retry_attempts + 1):
+            try:
+                resp = self._get_response(self.url_start_page)
+                break
+            except loader.TransientError as e:
+                if attempt == self.retry_attempts:
+                    raise
+                time.sleep(
+                    loader.backoff_delay(
+                        attempt, self.retry_wait, self.max_retry_wait, e.retry_after
+                    )
+                )
         root_start_page = lxml.html.fromstring(resp.text)
         languages = scraper.languages(root_start_page)
         self.logger.info(
@@ -79,32 +160,47 @@ class TPCollector:
         return languages
 
     def _collect_language_infos(self):
-        """Load an overview of available companies for each language."""
+        """Load an overview of available companies for each language.
+        The sub sitemaps of all languages are loaded concurrently, parsed
+        as a stream and requested conditionally: unchanged sub sitemaps
+        are taken from the sitemap cache.
+        """
         lang_info = []
         lang_company_urls = {}
-        lang_category_urls = {}
-        languages = tqdm(
-            self.available_languages.items(),
-            ncols=100,
-            desc="Load language.",
-            unit=" Languages",
-        )
-        for lang_id, lang in languages:
+        sitemap_urls_by_lang = {}
+        for lang_id in self.available_languages:
             sitemap_url_base = f"{self.url_sitemap_base}/index_{lang_id}.xml"
-            resp = self._get_response(sitemap_url_base)
-            tree = lxml.etree.fromstring(
-                resp.text.encode(), base_url=self.url_sitemap_base
-            )
+            resp = self._get_sitemap_response(sitemap_url_base, stream=True)
             # Get the sub sitmaps incl. all available page urls
-            sitemap_urls = loader.extract_sitemap_urls(tree)
+            sitemap_urls_by_lang[lang_id] = list(
+                loader.iter_sitemap_urls(_response_stream(resp))
+            )
+        sitemap_urls = [
+            (lang_id, sitemap_url)
+            for lang_id, urls in sitemap_urls_by_lang.items()
+            for sitemap_url in urls
+        ]
+        company_urls_by_sitemap = {}
+        n_unchanged = 0
+        with ThreadPoolExecutor(max_workers=self.n_sitemap_workers) as executor:
+            futures = {
+                executor.submit(self._load_sitemap_company_urls, url): url
+                for _, url in sitemap_urls
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                ncols=100,
+                desc="Load sitemaps.",
+                unit=" Sitemaps",
+            ):
+                company_urls, changed = future.result()
+                company_urls_by_sitemap[futures[future]] = company_urls
+                n_unchanged += not changed
+        for lang_id, lang in self.available_languages.items():
             company_urls = []
-            for idx, sitemap_url in enumerate(sitemap_urls):
-                resp = self._get_response(sitemap_url)
-                tree = lxml.etree.fromstring(
-                    resp.text.encode(), base_url=self.url_sitemap_base
-                )
-                company_urls_sub = loader.extract_company_urls(tree)
-                company_urls.extend(company_urls_sub)
+            for sitemap_url in sitemap_urls_by_lang[lang_id]:
+                company_urls.extend(company_urls_by_sitemap[sitemap_url])
             lang_info.append(
                 dict(
                     lang_id=lang_id,
@@ -114,71 +210,535 @@ class TPCollector:
             )
             lang_company_urls[lang_id] = company_urls
         self.logger.info(
-            f"Company page urls for {len(lang_info)} languages loaded."
+            f"Company page urls for {len(lang_info)} languages loaded ({n_unchanged} of {len(sitemap_urls)} sitemaps unchanged)."
         )
         return lang_info, lang_company_urls
 
+    def _load_sitemap_company_urls(self, sitemap_url):
+        """Company urls of a sub sitemap.
+        Returns `(company_urls, changed)`.
+        """
+        cached = self.sitemap_cache.get(sitemap_url)
+        resp = self._get_sitemap_response(
+            sitemap_url,
+            headers=sitemap_cache.conditional_headers(cached),
+            stream=True,
+        )
+        if resp.status_code == 304 and cached is not None:
+            resp.close()
+            return cached["company_urls"], False
+        company_urls = list(loader.iter_company_urls(_response_stream(resp)))
+        self.sitemap_cache.put(sitemap_url, resp.headers, company_urls)
+        return company_urls, True
 
     def load_reviews_by_lang(
-        self, language_id, limit=None, max_pages_by_company=None
+        self,
+        language_id,
+        limit=None,
+        max_pages_by_company=None,
+        n_workers=None,
+        checkpoint=None,
+        incremental=False,
+        company_keys=None,
+        n_parse_workers=None,
+        priority="random",
+        archive=None,
+    ):
+        """Iterate over all review pages of all companies of a language.
+        With `n_workers` > 1 up to `n_workers` requests are kept in flight
+        (the global rate limit of `_get_response` still applies).
+        With `n_parse_workers` the pages are parsed in a process pool (use
+        together with `n_workers` to parse several pages at once).
+        With a `checkpoint` (checkpoint.CheckpointStore) the progress is
+        staged for each requested page and an unfinished run is resumed.
+        `incremental` (needs a `checkpoint`) skips companies whose sitemap
+        `last_mod` did not change since the last harvest and stops paging a
+        company at the first page with reviews already harvested.
+        `company_keys` restricts the companies to a set of canonical company
+        keys (see `canonical.assign_locales`).
+        `priority` orders the companies (see `scheduler.prioritize`).
+        With an `archive` (archive.ResponseArchive) the raw responses are
+        archived.
+        With a `work_queue.WorkQueue` as `checkpoint` the companies are
+        leased from a run shared with other worker processes.
+        """
+        if not isinstance(checkpoint, WorkQueue):
+            yield from self.load_reviews_by_langs(
+                [language_id],
+                limit=limit,
+                max_pages_by_company=max_pages_by_company,
+                n_workers=n_workers,
+                checkpoints={language_id: checkpoint},
+                incremental=incremental,
+                company_keys=None if company_keys is None else {language_id: company_keys},
+                n_parse_workers=n_parse_workers,
+                priority=priority,
+                archive=archive,
+            )
+            return
+        if self.language_overview is None:
+            raise Exception("Please load language infos using setup() first")
+        if not checkpoint.resumed:
+            # the first worker starts the run, the others join it
+            self._company_urls_to_load(
+                language_id, limit, checkpoint, incremental, company_keys, priority
+            )
+        url_queue = LeasedFrontier(checkpoint, batch_size=n_workers or 1)
+        urls_to_load = checkpoint.n_companies()
+        self.logger.info(
+            f"Worker {checkpoint.worker_id} joined run from {checkpoint.start_date} ({urls_to_load} companies)."
+        )
+        yield from self._load_reviews(
+            url_queue,
+            urls_to_load,
+            {language_id: checkpoint},
+            max_pages_by_company,
+            n_workers,
+            incremental,
+            n_parse_workers,
+            archive,
+        )
+
+    def load_reviews_by_langs(
+        self,
+        language_ids,
+        weights=None,
+        limit=None,
+        max_pages_by_company=None,
+        n_workers=None,
+        checkpoints=None,
+        incremental=False,
+        company_keys=None,
+        n_parse_workers=None,
+        priority="random",
+        archive=None,
     ):
+        """Iterate over the review pages of several languages in one run.
+        The requests are shared between the languages by their `weights`
+        (dict language id -> weight, default 1) and the companies of a
+        language are loaded in the order of `priority` (see
+        `scheduler.FairShareScheduler`).
+        `limit` applies to each language. `checkpoints` and `company_keys`
+        are dicts by language id, for the other arguments see
+        `load_reviews_by_lang`. The stats of a page name its language.
+        """
         if self.language_overview is None:
             raise Exception("Please load language infos using setup() first")
-        urls = self.language_company_urls[language_id]
-        random.shuffle(urls)
-        url_queue = queue.Queue(maxsize=0)
-        if limit is not None:
-            urls = urls[:limit]
-        urls_to_load = len(urls)
-        for url_info in urls:
-            url_info["page"] = 1
-            url_queue.put(url_info)
-        urls_seen = set()
+        checkpoints = checkpoints or {}
+        weights = weights or {}
+        if incremental and any(
+            checkpoints.get(language_id) is None for language_id in language_ids
+        ):
+            raise ValueError("Incremental harvesting needs a checkpoint.")
+        url_queue = FairShareScheduler(
+            {language_id: weights.get(language_id, 1) for language_id in language_ids}
+        )
+        urls_to_load = 0
+        for language_id in language_ids:
+            urls = self._company_urls_to_load(
+                language_id,
+                limit,
+                checkpoints.get(language_id),
+                incremental,
+                None if company_keys is None else company_keys[language_id],
+                priority,
+            )
+            urls_to_load += len(urls)
+            url_queue.add_companies(language_id, urls)
+        yield from self._load_reviews(
+            url_queue,
+            urls_to_load,
+            checkpoints,
+            max_pages_by_company,
+            n_workers,
+            incremental,
+            n_parse_workers,
+            archive,
+        )
+
+    def _load_reviews(
+        self,
+        url_queue,
+        urls_to_load,
+        checkpoints,
+        max_pages_by_company=None,
+        n_workers=None,
+        incremental=False,
+        n_parse_workers=None,
+        archive=None,
+    ):
+        """Load the pages of the companies in the frontier `url_queue`.
+        Next pages are put into the frontier, the progress of each language
+        is staged in its checkpoint of `checkpoints`.
+        If the number of pages of a company is known from its first page
+        fetched (see `scraper.total_pages`), the paging stops at the last
+        page instead of probing for the 404. With `predictive_pagination`
+        (not for `incremental` runs) up to `pages_ahead` pages of the
+        company are queued at once, refilled as pages complete.
+        """
+        # pages queued ahead (`due`) and not yet queued (`remaining`) of the
+        # companies paged predictively
+        due_pages = {}
         n_sub_pages = 0
         n_pages_finished = 0
         params = dict(sort="recency")
-        while not url_queue.empty():
-            url_info = url_queue.get()
-            url = url_info["url"]
-            page = url_info["page"]
-            last_mod = url_info["last_mod"]
-            response, next_page = self.get_page(url, params, page)
-            # @todo: insert date check here
-            if next_page is not None:
-                if max_pages_by_company is not None and next_page > max_pages_by_company:
-                    next_page = None
-                    self.logger.warning(
-                        f"For {url} only {page} pages are tested. Maybe there are more."
+        parse_executor = None
+        if n_parse_workers:
+            parse_executor = ProcessPoolExecutor(max_workers=n_parse_workers)
+        try:
+            fetched_pages = self._fetch_pages(
+                url_queue, params, n_workers, parse_executor
+            )
+            for url_info, response, next_page, failed, page_data_info in fetched_pages:
+                url = url_info["url"]
+                page = url_info["page"]
+                language_id = url_info["language_id"]
+                checkpoint = checkpoints.get(language_id)
+                company_key = loader.company_key_from_url(url)
+                if not url_queue.holds(url_info):
+                    # another worker leased the company meanwhile
+                    self._lease_lost(url_info)
+                    due_pages.pop((language_id, company_key), None)
+                    continue
+                review_dates = []
+                n_pages = None
+                if page_data_info is not None:
+                    review_dates = scraper.review_dates(page_data_info["jsonld"])
+                    n_pages = page_data_info.get("total_pages")
+                if (language_id, company_key) in due_pages:
+                    pages = due_pages[language_id, company_key]
+                    pages["due"].discard(page)
+                    if response is None and not failed:
+                        # 404: fewer pages than announced
+                        pages["remaining"].clear()
+                    self._queue_ahead(url_queue, url_info, pages)
+                    next_page = min(pages["due"], default=None)
+                    if next_page is None:
+                        del due_pages[language_id, company_key]
+                else:
+                    next_page = self._next_page(
+                        url_queue,
+                        url_info,
+                        next_page,
+                        n_pages,
+                        review_dates,
+                        checkpoint,
+                        max_pages_by_company,
+                        incremental,
+                        due_pages,
                     )
-            if next_page is not None:
-                url_queue.put(dict(url=url, page=next_page, last_mod=last_mod))
-            if response is not None:
-                page_data_info = self._scrape_structured_infos(response)
-                page_data_info |= dict(url_base=url, page=page, url_request=url)
-                page_data_info["url_base_last_mod"] = url_info["last_mod"]
-                company_key = url.split("/review/")[1]
-                page_data_info["company_key"] = company_key
-                urls_seen.add(url)
-                n_sub_pages += 1
-                url_queue.task_done()
-                stats = dict(
-                        pages_started=len(urls_seen),
-                        pages_finished=n_pages_finished,
-                        pages_total=urls_to_load,
-                        sub_pages_loaded=n_sub_pages,
-                        language_id=language_id,
-                        current_url=url,
-                        current_page=page,
-                        len_queue=url_queue.qsize(),
+                if checkpoint is not None:
+                    checkpoint.record_page(
+                        company_key,
+                        page,
+                        next_page,
+                        fetched=response is not None,
+                        failed=failed,
+                        newest_review_date=max(review_dates, default=None),
+                    )
+                self.metrics.set("frontier_size", url_queue.qsize())
+                if page_data_info is not None:
+                    if archive is not None:
+                        archive.add(url_info, response, page_data_info["date"])
+                    page_data_info |= dict(url_base=url, page=page, url_request=url)
+                    page_data_info["url_base_last_mod"] = url_info["last_mod"]
+                    page_data_info["company_key"] = company_key
+                    n_sub_pages += 1
+                    url_queue.task_done()
+                    stats = dict(
+                            pages_started=url_queue.n_started,
+                            pages_finished=n_pages_finished,
+                            pages_total=urls_to_load,
+                            sub_pages_loaded=n_sub_pages,
+                            language_id=language_id,
+                            current_url=url,
+                            current_page=page,
+                            len_queue=url_queue.qsize(),
+                    )
+                    yield page_data_info, stats
+                if next_page is None:
+                    n_pages_finished += 1
+        finally:
+            if parse_executor is not None:
+                parse_executor.shutdown()
+
+    def _next_page(
+        self,
+        url_queue,
+        url_info,
+        next_page,
+        n_pages,
+        review_dates,
+        checkpoint,
+        max_pages_by_company,
+        incremental,
+        due_pages,
+    ):
+        """Queue the next page(s) of a company after a page was requested.
+        Returns the next page due (None if the company is finished).
+        """
+        url = url_info["url"]
+        page = url_info["page"]
+        company_key = loader.company_key_from_url(url)
+        if incremental and next_page is not None and review_dates:
+            # pages are sorted by recency: older pages are known
+            watermark = checkpoint.newest_review_date(company_key)
+            if watermark is not None and min(review_dates) <= watermark:
+                self.logger.debug(
+                    f"{url}: page {page} reaches reviews of the last harvest ({watermark})."
+                )
+                next_page = None
+        if next_page is not None and n_pages is not None:
+            if max_pages_by_company is not None and n_pages > max_pages_by_company:
+                self.logger.warning(
+                    f"For {url} only {max_pages_by_company} of {n_pages} pages are loaded."
+                )
+                n_pages = max_pages_by_company
+            if page >= n_pages:
+                return None
+            if self.predictive_pagination and not incremental:
+                remaining = set(range(next_page, n_pages + 1))
+                if checkpoint is not None:
+                    # pages fetched before a resume
+                    remaining -= checkpoint.fetched_pages(company_key)
+                pages = dict(due=set(), remaining=sorted(remaining, reverse=True))
+                self._queue_ahead(url_queue, url_info, pages)
+                if pages["due"]:
+                    due_pages[url_info["language_id"], company_key] = pages
+                return min(pages["due"], default=None)
+        if next_page is not None:
+            if max_pages_by_company is not None and next_page > max_pages_by_company:
+                next_page = None
+                self.logger.warning(
+                    f"For {url} only {page} pages are tested. Maybe there are more."
+                )
+        if next_page is not None:
+            url_queue.put(url_info | dict(page=next_page))
+        return next_page
+
+    def _queue_ahead(self, url_queue, url_info, pages):
+        """Queue the next remaining pages of a company until `pages_ahead`
+        pages are due."""
+        while pages["remaining"] and len(pages["due"]) < self.pages_ahead:
+            page = pages["remaining"].pop()
+            pages["due"].add(page)
+            url_queue.put(url_info | dict(page=page))
+
+    def _company_urls_to_load(
+        self, language_id, limit, checkpoint, incremental, company_keys, priority
+    ):
+        """Url infos of the companies to load in the order of `priority`
+        (and start the checkpoint run) or the pending companies of a
+        resumed run (in the order of the run, with the `page` due).
+        The url infos are streamed from the sitemap store into compact
+        columns (`scheduler.CompanyColumns`), no list of dicts is kept."""
+        if checkpoint is not None and checkpoint.resumed:
+            urls = CompanyColumns(checkpoint.pending())
+            self.logger.info(
+                f"Resume run from {checkpoint.start_date}: {len(urls)} of {checkpoint.n_companies()} companies pending."
+            )
+        else:
+            urls = self._company_url_stream(language_id)
+            if company_keys is not None:
+                urls = (
+                    url_info
+                    for url_info in urls
+                    if canonical_company_key(url_info["url"]) in company_keys
                 )
-                yield page_data_info, stats
-            if response is None or next_page is None:
-                n_pages_finished += 1
+            urls = CompanyColumns(urls)
+            if incremental:
+                n_urls = len(urls)
+                urls = CompanyColumns(checkpoint.modified(urls))
+                self.logger.info(
+                    f"Incremental: {n_urls - len(urls)} of {n_urls} companies not modified since the last harvest."
+                )
+            page_counts = None
+            if priority == "reviews" and checkpoint is not None:
+                page_counts = checkpoint.page_counts()
+            urls = prioritize(urls, priority, page_counts, limit)
+            if checkpoint is not None:
+                checkpoint.start(urls)
+        return urls
 
+    def _company_url_stream(self, language_id):
+        """Company url infos of a language, read from the sitemap store
+        without caching them (see `LanguageCompanyUrls.stream`)."""
+        if isinstance(self.language_company_urls, LanguageCompanyUrls):
+            return self.language_company_urls.stream(language_id)
+        return iter(self.language_company_urls[language_id])
+
+    def _fetch_pages(self, url_queue, params, n_workers=None, parse_executor=None):
+        """Fetch and parse the pages queued in `url_queue`.
+        Yields `(url_info, response, next_page, failed, page_data_info)`.
+        The consumer may put further pages into `url_queue` while iterating.
+        Sequential for `n_workers` None or 1, otherwise a thread pool keeps
+        up to `n_workers` requests in flight. Pages are parsed by the
+        fetching thread or in the processes of `parse_executor` while the
+        next pages are fetched (up to `2 * n_workers` pages in parsing).
+        Pages failing with a transient error (`loader.TransientError`) are
+        deferred (exponential backoff with jitter, `Retry-After`) and tried
+        up to `retry_attempts` times, other pages are fetched meanwhile.
+        """
+        retries = RetryQueue()
+        # pages parsed in `parse_executor`: parse future -> fetch result
+        parsing = {}
+        max_parsing = 2 * max(n_workers or 1, 1)
+        if n_workers is None or n_workers <= 1:
+            while retries or parsing or not url_queue.empty():
+                yield from self._parsed(parsing, timeout=0)
+                due = None
+                if len(parsing) < max_parsing:
+                    due = self._next_due(url_queue, retries)
+                if due is None:
+                    if parsing:
+                        yield from self._parsed(parsing, timeout=retries.wait_time())
+                    elif retries:
+                        time.sleep(retries.wait_time())
+                    continue
+                url_info, attempt = due
+                try:
+                    result = self._fetch_page(
+                        url_info["url"], params, url_info["page"], parse_executor
+                    )
+                except loader.TransientError as e:
+                    if self._defer(url_queue, retries, url_info, attempt, e):
+                        continue
+                    result = None, None, True, None
+                yield from self._fetched(parsing, url_info, result)
+            return
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            while in_flight or parsing or retries or not url_queue.empty():
+                while len(in_flight) < n_workers and len(parsing) < max_parsing:
+                    due = self._next_due(url_queue, retries)
+                    if due is None:
+                        break
+                    url_info, _ = due
+                    future = executor.submit(
+                        self._fetch_page,
+                        url_info["url"],
+                        params,
+                        url_info["page"],
+                        parse_executor,
+                    )
+                    in_flight[future] = due
+                if not in_flight and not parsing:
+                    # nothing due: wait for a retry (pages of lost leases
+                    # may have emptied the frontier)
+                    if retries:
+                        time.sleep(retries.wait_time())
+                    continue
+                done, _ = wait(
+                    [*in_flight, *parsing],
+                    timeout=retries.wait_time(),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    if future in parsing:
+                        url_info, *result = parsing.pop(future)
+                        yield url_info, *result, future.result()
+                        continue
+                    url_info, attempt = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except loader.TransientError as e:
+                        if self._defer(url_queue, retries, url_info, attempt, e):
+                            continue
+                        result = None, None, True, None
+                    yield from self._fetched(parsing, url_info, result)
+
+    def _fetched(self, parsing, url_info, result):
+        """Yield a fetched page, or hold it in `parsing` until its parse
+        future (page data info from `parse_executor`) is done."""
+        resp, next_page, failed, page_data_info = result
+        if isinstance(page_data_info, Future):
+            parsing[page_data_info] = url_info, resp, next_page, failed
+        else:
+            yield url_info, *result
+
+    def _parsed(self, parsing, timeout=None):
+        """Yield the pages of `parsing` parsed within `timeout` seconds."""
+        done, _ = wait(parsing, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            url_info, *result = parsing.pop(future)
+            yield url_info, *result, future.result()
+
+    def _next_due(self, url_queue, retries):
+        """Next page to request with its attempt: a due retry first, else
+        a page of the frontier (None if neither is available). Pages of
+        companies whose lease was lost (see `url_queue.holds`) are
+        dropped."""
+        while True:
+            due = retries.pop_due()
+            if due is None and not url_queue.empty():
+                due = url_queue.get(), 1
+            if due is None or url_queue.holds(due[0]):
+                break
+            self._lease_lost(due[0])
+        self.metrics.set("retry_queue_size", len(retries))
+        return due
+
+    def _lease_lost(self, url_info):
+        self.logger.warning(
+            f"Lease of {url_info['url']} lost to another worker. Page {url_info['page']} dropped."
+        )
+        self.metrics.inc("leases_lost_total")
+
+    def _defer(self, url_queue, retries, url_info, attempt, error):
+        """Queue a page for another try after a transient error (the lease
+        of its company is renewed for the delay).
+        Returns False if all `retry_attempts` are used.
+        """
+        url = url_info["url"]
+        page = url_info["page"]
+        if attempt >= self.retry_attempts:
+            self.logger.error(
+                f"Request failed for {url} (page {page}) after {attempt} attempts: {error}"
+            )
+            self.metrics.inc("retries_exhausted_total")
+            return False
+        delay = loader.backoff_delay(
+            attempt, self.retry_wait, self.max_retry_wait, error.retry_after
+        )
+        if not url_queue.holds(url_info, delay):
+            self._lease_lost(url_info)
+            return True
+        retries.put(url_info, attempt + 1, delay)
+        self.metrics.inc("retries_total")
+        self.metrics.set("retry_queue_size", len(retries))
+        self.logger.info(f"Retry {url} (page {page}) in {delay:.1f} seconds: {error}")
+        return True
+
+    def _fetch_page(self, url, params, page, parse_executor=None):
+        """Request and parse a page. With a `parse_executor` the page data
+        info is a future (the fetching thread does not wait for it)."""
+        resp, next_page, failed = self._request_page(url, params, page)
+        page_data_info = None
+        if resp is not None:
+            page_data_info = self._scrape_structured_infos(
+                resp, parse_executor, page
+            )
+        return resp, next_page, failed, page_data_info
 
     def get_page(self, url, params, page):
+        try:
+            resp, next_page, _ = self._request_page(url, params, page)
+        except loader.TransientError as e:
+            self.logger.error(f"Request failed for {url}: {e}")
+            return None, None
+        return resp, next_page
+
+    def _request_page(self, url, params, page):
+        """Request a page of a company.
+        Returns `(resp, next_page, failed)`. `failed` is True if the page
+        could not be loaded because of an error (not for the 404 after the
+        last page or a redirect). Transient errors are raised
+        (`loader.TransientError`, to be retried by the caller).
+        """
         next_page = page + 1
-        params |= dict(page=page)
+        failed = False
+        # copy: params are shared between (concurrent) calls
+        params = params | dict(page=page)
         if (
             page == 1
         ):  # if a parameter page=1 exits, the request is forwarded to the page without any paramter. Other parameters like "sort=recency" are not handled anymore.
@@ -205,25 +765,46 @@ class TPCollector:
                     f"Request failed for {url}. Stopped on page {page -1}: {e}"
                 )
                 next_page = None
-        except RetryError as e:
+                failed = True
+        except loader.TransientError:
+            raise
+        except Exception as e:
             self.logger.error(
                 f"Request failed for {url}. Stopped on page {page -1}: {e}"
             )
             next_page = None
-        except Exception as e:
-            self.logger.error(f"Request failed for {url}: {e}")
-        return resp, next_page
+            failed = True
+        return resp, next_page, failed
 
-    def _scrape_structured_infos(self, response):
+    def _scrape_structured_infos(self, response, parse_executor=None, page=1):
+        headers = dict(response.headers)
+        if self.projection is not None:
+            headers = self.projection.headers(headers)
         structured_infos = dict(
             url_response=response.url,
             date=utc_timestamp(),
-            headers=dict(response.headers),
+            headers=headers,
         )
-        tree = lxml.html.fromstring(response.text)
-        structured_infos["jsonld"] = scraper.jsonld(tree)
-        structured_infos["structured_page_content"] = scraper.structured_content_data(tree)
-        return structured_infos
+        if parse_executor is not None:
+            start = time.perf_counter()
+            future = parse_executor.submit(
+                _structured_page_infos,
+                structured_infos,
+                response.content,
+                self.projection,
+                page,
+            )
+            # time until parsed (with the transfer to the process pool)
+            future.add_done_callback(
+                lambda _: self.metrics.observe(
+                    "parse_seconds", time.perf_counter() - start
+                )
+            )
+            return future
+        with self.metrics.timer("parse_seconds"):
+            return _structured_page_infos(
+                structured_infos, response.content, self.projection, page
+            )
 
     def save_by_language(
         self,
@@ -233,61 +814,264 @@ class TPCollector:
         max_pages_by_company=None,
         min_year_mod=None,
         verbose=False,
+        n_workers=None,
+        state_path=None,
+        incremental=False,
+        company_keys=None,
+        output_format="tar",
+        compression="gzip",
+        background_writer=True,
+        n_parse_workers=None,
+        extract_reviews=False,
+        worker_id=None,
+        priority="random",
+        archive_path=None,
+    ):
+        """Harvest a language.
+        The pages are written by a `writer` backend (`output_format`):
+         * "tar": one tar.gz file (`<company_key>/<page>.json`)
+         * "shards": size rotated JSONL shards (gzip or zstd `compression`)
+           with an index of the pages (see `writer.ShardWriter`)
+         * "none": no pages (e.g. only reviews)
+        With `extract_reviews` one record per review is written in addition
+        (deduplicated by review id, see `writer.ReviewWriter`).
+        With `background_writer` serialization, compression and IO run in a
+        background thread.
+        With `state_path` the progress is checkpointed in a SQLite file. A
+        killed run is resumed by the next call (tar: the remaining pages
+        are written into an additional tar.gz part). Pages are committed to
+        the checkpoint after they are persisted, a tar.gz of a killed run
+        is readable (streamed) up to the last checkpoint.
+        `incremental` (needs `state_path`) only loads reviews that are new
+        since the last harvest (see `load_reviews_by_lang`).
+        `priority` orders the companies (see `scheduler.prioritize`).
+        With `archive_path` the raw responses are archived (see
+        `archive.ResponseArchive`, re-parse them with `archive.replay`).
+        With a `worker_id` (needs `state_path`) several processes share the
+        run: each leases companies from the checkpoint and writes its own
+        output (`<name>-worker-<worker_id>`), see `work_queue.WorkQueue`.
+        """
+        self._save(
+            base_path,
+            [language_id],
+            company_keys=None if company_keys is None else {language_id: company_keys},
+            limit=limit,
+            max_pages_by_company=max_pages_by_company,
+            min_year_mod=min_year_mod,
+            verbose=verbose,
+            n_workers=n_workers,
+            state_path=state_path,
+            incremental=incremental,
+            output_format=output_format,
+            compression=compression,
+            background_writer=background_writer,
+            n_parse_workers=n_parse_workers,
+            extract_reviews=extract_reviews,
+            worker_id=worker_id,
+            priority=priority,
+            archive_path=archive_path,
+        )
+
+    def save_by_languages(
+        self, base_path, language_ids, dedup="once", weights=None, **kwargs
     ):
-        start_date = datetime.datetime.today().strftime("%Y-%m-%d")
+        """Harvest several locales in one run, one output each.
+        Companies listed in several locales are deduplicated by their
+        canonical company key (see `canonical.assign_locales` for the
+        `dedup` modes). The requests are shared between the locales by
+        their `weights` (see `load_reviews_by_langs`). Workers
+        (`worker_id`) harvest the locales one after another.
+        Further arguments are passed to `save_by_language`.
+        """
+        if self.language_overview is None:
+            raise Exception("Please load language infos using setup() first")
+        assignment = assign_locales(
+            {language_id: self._company_url_stream(language_id) for language_id in language_ids},
+            language_ids,
+            dedup,
+        )
+        n_companies = {info["lang_id"]: info["n_companies"] for info in self.language_overview}
+        for language_id in language_ids:
+            n_total = n_companies[language_id]
+            self.logger.info(
+                f"{language_id}: {len(assignment[language_id])} of {n_total} companies are harvested in this locale (dedup: {dedup})."
+            )
+        if kwargs.get("worker_id") is not None:
+            for language_id in language_ids:
+                self.save_by_language(
+                    base_path,
+                    language_id,
+                    company_keys=assignment[language_id],
+                    **kwargs,
+                )
+            return
+        self._save(
+            base_path, language_ids, company_keys=assignment, weights=weights, **kwargs
+        )
+
+    def _save(
+        self,
+        base_path,
+        language_ids,
+        company_keys=None,
+        weights=None,
+        limit=None,
+        max_pages_by_company=None,
+        min_year_mod=None,
+        verbose=False,
+        n_workers=None,
+        state_path=None,
+        incremental=False,
+        output_format="tar",
+        compression="gzip",
+        background_writer=True,
+        n_parse_workers=None,
+        extract_reviews=False,
+        worker_id=None,
+        priority="random",
+        archive_path=None,
+    ):
+        """Harvest languages in one run (see `save_by_language`)."""
+        if incremental and state_path is None:
+            raise ValueError("Incremental harvesting needs a state_path.")
+        if worker_id is not None and state_path is None:
+            raise ValueError("Workers need a shared state_path.")
+        if worker_id is not None and len(language_ids) > 1:
+            raise ValueError("A worker harvests one language at a time.")
+        if worker_id is not None and not re.fullmatch(WORKER_ID_PATTERN, worker_id):
+            raise ValueError("A worker_id consists of letters, digits and _ only.")
         # if min_year_mod is not None:
         #    urls = [u for u in urls if int(u["last_mod"][:4]) >= min_year_mod]
         #    print(f"{len(urls)} companies have data modified after {min_year_mod}")
         base_path = Path(base_path)
         base_path.mkdir(parents=True, exist_ok=True)
-        tar_filename = (
-            f"{start_date}-{language_id}-trustpilot-reviews-jsonld.tar.gz"
-        )
-        tar_filename = base_path / tar_filename
-        self.logger.info(f"Persistance file name: {tar_filename}")
-        with tarfile.open(tar_filename, "w:gz") as tar:
+        checkpoints = {}
+        writers = {}
+        archive = None
+        if archive_path is not None:
+            archive = ResponseArchive(archive_path)
+        try:
+            for language_id in language_ids:
+                start_date = datetime.datetime.today().strftime("%Y-%m-%d")
+                checkpoint = None
+                part = ""
+                if worker_id is not None:
+                    checkpoint = WorkQueue(state_path, language_id, worker_id)
+                elif state_path is not None:
+                    checkpoint = CheckpointStore(state_path, language_id)
+                if checkpoint is not None:
+                    checkpoints[language_id] = checkpoint
+                    if checkpoint.resumed:
+                        start_date = checkpoint.start_date
+                        part = f"-{checkpoint.n_sessions}"
+                name = f"{start_date}-{language_id}-trustpilot-reviews-jsonld"
+                if worker_id is not None:
+                    name = f"{name}-worker-{worker_id}"
+                writers[language_id] = open_writer(
+                    base_path,
+                    name,
+                    output_format=output_format,
+                    compression=compression,
+                    background=background_writer,
+                    part=part,
+                    extract_reviews=extract_reviews,
+                    metrics=self.metrics,
+                )
+                self.logger.info(f"Persistance: {base_path / name} ({output_format})")
             start_total = time.time()
-            json_lds_iter = self.load_reviews_by_lang(
-                language_id,
+            load_args = dict(
                 limit=limit,
                 max_pages_by_company=max_pages_by_company,
+                n_workers=n_workers,
+                incremental=incremental,
+                n_parse_workers=n_parse_workers,
+                priority=priority,
+                archive=archive,
             )
-            total_urls = len(self.language_company_urls[language_id])
+            if worker_id is not None:
+                (language_id,) = language_ids
+                json_lds_iter = self.load_reviews_by_lang(
+                    language_id,
+                    checkpoint=checkpoints[language_id],
+                    company_keys=None if company_keys is None else company_keys[language_id],
+                    **load_args,
+                )
+            else:
+                json_lds_iter = self.load_reviews_by_langs(
+                    language_ids,
+                    weights=weights,
+                    checkpoints=checkpoints,
+                    company_keys=company_keys,
+                    **load_args,
+                )
             for json_ld_info, stats in json_lds_iter:
+                language_id = stats["language_id"]
                 page = json_ld_info["page"]
                 company_key = json_ld_info["company_key"]
-                filename = f"{company_key}/{page}.json"
-                _add_data_to_tar(tar, json_ld_info, filename)
+                checkpoint = checkpoints.get(language_id)
+                on_persisted = None
+                if checkpoint is not None:
+                    # the page is marked as done after it is persisted
+                    on_persisted = partial(checkpoint.commit, checkpoint.mark())
+                writer = writers[language_id]
+                writer.write(company_key, page, json_ld_info, on_persisted)
+                if background_writer:
+                    self.metrics.set(
+                        "writer_queue_size", writer.qsize(), language_id=language_id
+                    )
                 end_persist = time.time()
                 total_time = end_persist - start_total
                 time_per_page = total_time / stats["sub_pages_loaded"]
+                rate = self.rate_limiter.rate_per_minute
+                rate = "-" if rate is None else f"{rate:.0f}"
                 print(
-                        f"\rcompanies: ({stats['pages_finished']}, {stats['pages_started']}, {stats['pages_total']}) | n_pages: {stats['sub_pages_loaded']} current_page_nr: {stats['current_page']} | time_total: {total_time:.0f} | one_page: {time_per_page:5.1f} | {company_key} ",
+                        f"\rcompanies: ({stats['pages_finished']}, {stats['pages_started']}, {stats['pages_total']}) | n_pages: {stats['sub_pages_loaded']} current_page_nr: {stats['current_page']} | rate: {rate}/min | time_total: {total_time:.0f} | one_page: {time_per_page:5.1f} | {language_id} {company_key} ",
                     end="",
                 )
+        finally:
+            for writer in writers.values():
+                writer.close()
+            if archive is not None:
+                archive.close()
+            if worker_id is not None:
+                for checkpoint in checkpoints.values():
+                    checkpoint.release()
+        for checkpoint in checkpoints.values():
+            checkpoint.finish()
+            checkpoint.close()
         print()
 
     def load_page_map_infos(self):
-        tar_filename = self._get_last_page_map_info_tar_gz()
-        if tar_filename is None:
+        """Open the last sitemap snapshot.
+        Company urls of a language are loaded from the indexed store on
+        first access. Snapshots of older versions (tar.gz) are loaded
+        completely.
+        """
+        snapshot_filename = self._get_last_page_map_info_snapshot()
+        if snapshot_filename is None:
             self.logger.info(
                 "No language and url data found. load data with .setup() (takes ~10 minutes)."
             )
             return
-        print(tar_filename)
         today = datetime.datetime.today().strftime("%Y-%m-%d")
-        tar_file_date = tar_filename.name[:-7]
+        snapshot_date = snapshot_filename.name[:10]
         self.logger.info(
-            f"Load language and url data from {tar_file_date} ..."
+            f"Load language and url data from {snapshot_date} ..."
         )
-        if today > tar_file_date:
+        if today > snapshot_date:
             self.logger.info(
-                f"language and url data might be outdated (Loaded on {tar_file_date}. Reload with .setup()"
+                f"language and url data might be outdated (Loaded on {snapshot_date}. Reload with .setup()"
             )
-        with tarfile.open(tar_filename, "r:gz") as tar:
-            self.available_languages = _read_data_from_tar(tar, "available_languages.json")
-            self.language_overview = _read_data_from_tar(tar, "language_overview.json")
-            self.language_company_urls = _read_data_from_tar(tar, "language_company_urls.json")
+        if snapshot_filename.suffix == ".sqlite":
+            self.sitemap_store = SitemapStore(snapshot_filename)
+            self.available_languages = self.sitemap_store.available_languages()
+            self.language_overview = self.sitemap_store.language_overview()
+            self.language_company_urls = LanguageCompanyUrls(self.sitemap_store)
+        else:
+            with tarfile.open(snapshot_filename, "r:gz") as tar:
+                self.available_languages = _read_data_from_tar(tar, "available_languages.json")
+                self.language_overview = _read_data_from_tar(tar, "language_overview.json")
+                self.language_company_urls = _read_data_from_tar(tar, "language_company_urls.json")
         self.logger.info(
             f"Load language and url data for {len(self.language_overview)} languages."
         )
@@ -297,30 +1081,62 @@ class TPCollector:
         path = self.path_page_map_infos
         sitemap_date = datetime.datetime.today().strftime("%Y-%m-%d")
         path.mkdir(parents=True, exist_ok=True)
-        tar_filename = path / f"{sitemap_date}.tar.gz"
-        with tarfile.open(tar_filename, "w:gz") as tar:
-            filename = "available_languages.json"
-            _add_data_to_tar(tar, self.available_languages, filename)
-            filename = "language_overview.json"
-            _add_data_to_tar(tar, self.language_overview, filename)
-            filename = "language_company_urls.json"
-            _add_data_to_tar(tar, self.language_company_urls, filename)
-
-    def _get_last_page_map_info_tar_gz(self):
+        if self.sitemap_store is not None:
+            self.sitemap_store.close()
+        self.sitemap_store = SitemapStore.create(
+            path / f"{sitemap_date}.sqlite",
+            self.available_languages,
+            self.language_overview,
+            self.language_company_urls,
+        )
+
+    def _get_last_page_map_info_snapshot(self):
         path = self.path_page_map_infos
-        sub_folder = glob(f"{str(path)}/*.tar.gz")
         year_pattern = re.compile(
             r"^[0-9]{4,4}-[0-9]{2,2}-[0-9]{2,2}$"
         )
-        tar_files = [Path(fn) for fn in sub_folder]
-        tar_files = [fn for fn in tar_files
-                     if year_pattern.match(fn.name[:-7])]
-        tar_files = [fn for fn in tar_files if not fn.is_dir()]
-        if not tar_files:
+        snapshots = []
+        for suffix in (".tar.gz", ".sqlite"):
+            for fn in glob(f"{str(path)}/*{suffix}"):
+                fn = Path(fn)
+                date = fn.name[: -len(suffix)]
+                if year_pattern.match(date) and not fn.is_dir():
+                    # sqlite before tar.gz of the same date
+                    snapshots.append((date, suffix == ".sqlite", fn))
+        if not snapshots:
             return
-        tar_files.sort(key=lambda x: x.stem)
-        last_tar_file = tar_files[-1]
-        return last_tar_file
+        snapshots.sort()
+        return snapshots[-1][2]
+
+
+def _structured_page_infos(structured_infos, content, projection, page):
+    """Structured infos of a page with its parsed contents (picklable, for
+    the process pool of `TPCollector._scrape_structured_infos`)"""
+    return structured_infos | projected_page_infos(content, projection, page)
+
+
+def _response_stream(resp):
+    """Decoded body of a streamed response as a file like object.
+    A gzipped body (e.g. `.xml.gz`) is recognised by its magic bytes: a
+    `Content-Encoding: gzip` is already decoded by `decode_content`."""
+    resp.raw.decode_content = True
+    # buffered to peek, the buffer reads on until EOF
+    resp.raw.auto_close = False
+    stream = io.BufferedReader(resp.raw)
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def parse_weights(text):
+    """Weights by language id from 'de-de=3,de-at=1'"""
+    if not text:
+        return None
+    weights = {}
+    for item in text.split(","):
+        language_id, weight = item.split("=")
+        weights[language_id.strip()] = float(weight)
+    return weights
 
 
 def utc_timestamp():
@@ -336,14 +1152,6 @@ def _read_data_from_tar(tar, filename):
     data = json.loads(content)
     return data
 
-def _add_data_to_tar(tar, data, filename): 
-    data_raw = json.dumps(data)
-    data_raw_encoded = data_raw.encode("utf-8")
-    fileobj = io.BytesIO(data_raw_encoded)
-    tarinfo = tarfile.TarInfo(name=filename)
-    tarinfo.size = len(data_raw_encoded)
-    tar.addfile(tarinfo, fileobj)
-
 def are_effective_similar_urls(url, url_compare):
     # Parse the URLs
     parsed_url1 = urlparse(url)
@@ -365,11 +1173,29 @@ def main():
     # Define the obligatory parameters
    
     parser.add_argument("data_path", type=str, help="The path where you want to store the harvested data.")
-    parser.add_argument("language_id", type=str, help="language id for harvesting.")
+    parser.add_argument("language_id", type=str, help="language id for harvesting. Several language ids can be separated by comma, 'all' harvests all languages.")
     parser.add_argument("mail", type=str, help="Your email address (friendly crawling).")
     parser.add_argument("url", type=str, help="The URL of your institution (friendly crawling).")
     parser.add_argument("--limit", type=int, help="An optional limit of companies to crawl for the language.", default=None)
     parser.add_argument("--max_pages_by_company", type=int, help="An optional limit of pages to harvest for each company.", default=None)
+    parser.add_argument("--state_path", type=str, help="An optional SQLite file to checkpoint the progress. Interrupted runs are resumed.", default=None)
+    parser.add_argument("--dedup", type=str, choices=DEDUP_MODES, help="Deduplication of companies listed in several of the given locales (default: once).", default="once")
+    parser.add_argument("--incremental", action="store_true", help="Only load reviews which are new since the last harvest (needs --state_path).")
+    parser.add_argument("--output_format", type=str, choices=OUTPUT_FORMATS, help="Output backend: one tar.gz file, indexed JSONL shards or none (default: tar).", default="tar")
+    parser.add_argument("--compression", type=str, choices=COMPRESSIONS, help="Compression of the JSONL shards (zstd needs the package zstandard).", default="gzip")
+    parser.add_argument("--extract_reviews", action="store_true", help="Write one deduplicated record per review in addition (<name>-reviews/*.jsonl.gz).")
+    parser.add_argument("--pages_ahead", type=int, help="Queue up to N pages of a company at once if its number of pages is known (predictive pagination, default: one page after the other). Many pages at once may be throttled.", default=None)
+    parser.add_argument("--n_parse_workers", type=int, help="Number of processes parsing the pages (default: parse in the fetching threads).", default=None)
+    parser.add_argument("--n_workers", type=int, help="Number of requests kept in flight concurrently (default: sequential).", default=None)
+    parser.add_argument("--priority", type=str, choices=PRIORITIES, help="Order of the companies of a language: random, most recent sitemap last_mod or most reviews known from earlier runs (needs --state_path) first (default: random).", default="random")
+    parser.add_argument("--weights", type=str, help="Share of the requests of each language for several languages, e.g. 'de-de=3,de-at=1' (default: 1 each).", default=None)
+    parser.add_argument("--worker_id", type=str, help="Id of this worker process (letters, digits and _). Workers with the same --state_path share the run, each writes <name>-worker-<worker_id>.", default=None)
+    parser.add_argument("--keep_paths", type=str, help="Only store these key paths of __NEXT_DATA__, separated by comma (e.g. 'props.pageProps.reviews,props.pageProps.filters').", default=None)
+    parser.add_argument("--drop_paths", type=str, help="Do not store these key paths of __NEXT_DATA__, separated by comma.", default=None)
+    parser.add_argument("--compact", action="store_true", help="Trim the stored response headers and store company level fields only on the first page of a company.")
+    parser.add_argument("--archive_path", type=str, help="Archive the raw responses in this directory (re-parse with archive.py).", default=None)
+    parser.add_argument("--metrics_path", type=str, help="Write metrics snapshots every 10 seconds to <metrics_path>.json and <metrics_path>.prom (Prometheus textfile).", default=None)
+    parser.add_argument("--metrics_port", type=int, help="Serve the metrics on http://127.0.0.1:<port>/metrics (Prometheus) and /metrics.json.", default=None)
     
     # Parse the arguments
     args = parser.parse_args()
@@ -389,13 +1215,56 @@ def main():
         ],
     )
     harvester = TPCollector(args.url, args.mail, args.data_path)
+    if args.pages_ahead:
+        harvester.predictive_pagination = True
+        harvester.pages_ahead = args.pages_ahead
+    if args.keep_paths or args.drop_paths or args.compact:
+        harvester.projection = Projection(
+            keep_paths=args.keep_paths.split(",") if args.keep_paths else None,
+            drop_paths=args.drop_paths.split(",") if args.drop_paths else None,
+            compact=args.compact,
+        )
     if harvester.language_overview is None:
         print("Loading company url data first")
         harvester.setup()
-    harvester.save_by_language(
-        args.data_path, args.language_id, limit=args.limit,
-        max_pages_by_company=args.max_pages_by_company, verbose=False
+    if args.language_id == "all":
+        language_ids = list(harvester.available_languages)
+    else:
+        language_ids = args.language_id.split(",")
+    harvest_args = dict(
+        limit=args.limit,
+        max_pages_by_company=args.max_pages_by_company, verbose=False,
+        n_workers=args.n_workers, state_path=args.state_path,
+        incremental=args.incremental,
+        output_format=args.output_format, compression=args.compression,
+        n_parse_workers=args.n_parse_workers,
+        extract_reviews=args.extract_reviews,
+        worker_id=args.worker_id,
+        priority=args.priority,
+        archive_path=args.archive_path,
     )
+    metrics_reporter = None
+    metrics_server = None
+    if args.metrics_path is not None:
+        metrics_reporter = MetricsReporter(harvester.metrics, args.metrics_path)
+    if args.metrics_port is not None:
+        metrics_server = serve_metrics(harvester.metrics, args.metrics_port)
+    try:
+        if len(language_ids) == 1:
+            harvester.save_by_language(args.data_path, language_ids[0], **harvest_args)
+        else:
+            harvester.save_by_languages(
+                args.data_path,
+                language_ids,
+                dedup=args.dedup,
+                weights=parse_weights(args.weights),
+                **harvest_args,
+            )
+    finally:
+        if metrics_reporter is not None:
+            metrics_reporter.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,138 @@
+from collections import deque
+
+from checkpoint import SQL_NOW, CheckpointStore
+from loader import company_key_from_url
+
+
+class WorkQueue(CheckpointStore):
+    """Checkpoint run shared by several worker processes (or hosts on a
+    shared file system).
+
+    Workers lease companies of the run. The pages of a leased company are
+    fetched by its worker only, every persisted page renews the lease.
+    If a worker dies, its leases expire after `lease_seconds` and the
+    companies are leased again, starting at the next page due (pages
+    already persisted are not fetched twice). A worker whose lease
+    expired and was taken by another worker drops the company (see
+    `renew`), its progress is not recorded.
+    """
+
+    def __init__(self, path, language_id, worker_id, lease_seconds=600):
+        super().__init__(path, language_id)
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        # a restarted worker takes over the leases of its dead predecessor
+        self.release()
+
+    def lease(self, n=1):
+        """Lease up to `n` pending companies not leased by others.
+        Returns their url infos with the next page due.
+        """
+        with self._lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute(
+                "SELECT company_key, url, last_mod, next_page FROM companies "
+                "WHERE run_id = ? AND next_page IS NOT NULL "
+                f"AND (lease_expires IS NULL OR lease_expires < {SQL_NOW}) "
+                "ORDER BY position LIMIT ?",
+                (self.run_id, n),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE companies SET lease_owner = ?, "
+                f"lease_expires = {SQL_NOW} + ? "
+                "WHERE run_id = ? AND company_key = ?",
+                (
+                    (self.worker_id, self.lease_seconds, self.run_id, row[0])
+                    for row in rows
+                ),
+            )
+        return [
+            dict(
+                url=url,
+                last_mod=last_mod,
+                page=next_page,
+                language_id=self.language_id,
+            )
+            for _, url, last_mod, next_page in rows
+        ]
+
+    def renew(self, company_key, seconds=0):
+        """Renew the lease of a company (for `lease_seconds` + `seconds`).
+        Returns False if another worker leased it meanwhile."""
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                f"UPDATE companies SET lease_expires = {SQL_NOW} + ? "
+                "WHERE run_id = ? AND company_key = ? AND lease_owner = ?",
+                (
+                    self.lease_seconds + seconds,
+                    self.run_id,
+                    company_key,
+                    self.worker_id,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def release(self):
+        """Give back the leases of this worker (e.g. when stopping). The
+        staged progress is committed first, while the leases are held
+        (see `record_page`)."""
+        self.commit()
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE companies SET lease_owner = NULL, lease_expires = NULL "
+                "WHERE run_id = ? AND lease_owner = ?",
+                (self.run_id, self.worker_id),
+            )
+
+
+class LeasedFrontier:
+    """Queue like frontier (`get`, `put`, `empty`, `qsize`, `task_done`)
+    of a worker. Companies are leased from the work queue when the local
+    queue runs empty, next pages of leased companies are queued locally.
+    `holds` renews the lease of a company before its pages are fetched
+    and recorded. `n_started` counts the companies leased.
+    """
+
+    def __init__(self, work_queue, batch_size=1):
+        self.work_queue = work_queue
+        self.batch_size = batch_size
+        self._queue = deque()
+        self.n_started = 0
+
+    def _lease(self):
+        url_infos = self.work_queue.lease(self.batch_size)
+        self.n_started += len(url_infos)
+        self._queue.extend(url_infos)
+
+    def put(self, url_info):
+        self._queue.append(url_info)
+
+    def holds(self, url_info, seconds=0):
+        """Renew the lease of the company of a page (for `seconds` more
+        than the lease time). If the lease was lost to another worker, the
+        local pages of the company are dropped and False is returned."""
+        company_key = company_key_from_url(url_info["url"])
+        if self.work_queue.renew(company_key, seconds):
+            return True
+        self._queue = deque(
+            queued
+            for queued in self._queue
+            if company_key_from_url(queued["url"]) != company_key
+        )
+        return False
+
+    def get(self):
+        if not self._queue:
+            self._lease()
+        return self._queue.popleft()
+
+    def empty(self):
+        if not self._queue:
+            self._lease()
+        return not self._queue
+
+    def qsize(self):
+        return len(self._queue)
+
+    def task_done(self):
+        pass
@@ -0,0 +1,327 @@
+import io
+import re
+import gzip
+import json
+import time
+import zlib
+import queue
+import tarfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import scraper
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+OUTPUT_FORMATS = ("tar", "shards", "none")
+COMPRESSIONS = ("gzip", "zstd")
+SHARD_PATTERN = re.compile(r"^shard-([0-9]+)\.jsonl\.(gz|zst)$")
+REVIEW_PART_PATTERN = re.compile(r"^part-([0-9]+)\.jsonl\.gz$")
+# ids of worker processes, their output is `<name>-worker-<worker_id>`
+WORKER_ID_PATTERN = r"[A-Za-z0-9_]+"
+
+
+class TarWriter:
+    """Pages as json files (`<company_key>/<page>.json`) in one tar.gz.
+    Each page is flushed, the archive is readable as a stream up to the
+    last written page even if it was not closed.
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.tar = tarfile.open(self.filename, "w:gz")
+
+    def write(self, company_key, page, data, on_persisted=None):
+        _add_data_to_tar(self.tar, data, f"{company_key}/{page}.json")
+        self.tar.fileobj.flush(zlib.Z_SYNC_FLUSH)
+        if on_persisted is not None:
+            on_persisted()
+
+    def close(self):
+        self.tar.close()
+
+
+class ShardWriter:
+    """Pages as JSON lines in size rotated, compressed shards.
+
+    Each page is compressed separately (gzip member or zstd frame), so a
+    page can be read by its offset. The shards are still valid gzip/zstd
+    files. For each shard a sidecar index (`<shard>.idx`) lists
+    `company_key<TAB>page<TAB>offset<TAB>length` of its pages.
+    Writing to an existing directory (e.g. a resumed run) appends new
+    shards.
+    """
+
+    def __init__(self, path, max_shard_size=256 * 2**20, compression="gzip"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {compression}. Use one of {COMPRESSIONS}"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression needs the package zstandard")
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_shard_size = max_shard_size
+        self.compression = compression
+        self._compress = _compressor(compression)
+        self._shard_nr = max(
+            (
+                int(m.group(1))
+                for m in (SHARD_PATTERN.match(p.name) for p in self.path.iterdir())
+                if m
+            ),
+            default=-1,
+        )
+        self._file = None
+        self._index = None
+
+    def _next_shard(self):
+        self._close_shard()
+        self._shard_nr += 1
+        suffix = "gz" if self.compression == "gzip" else "zst"
+        filename = self.path / f"shard-{self._shard_nr:05d}.jsonl.{suffix}"
+        self._file = open(filename, "ab")
+        self._index = open(f"{filename}.idx", "a", encoding="utf-8")
+
+    def write(self, company_key, page, data, on_persisted=None):
+        record = self._compress(json.dumps(data).encode("utf-8") + b"\n")
+        if self._file is None or self._file.tell() >= self.max_shard_size:
+            self._next_shard()
+        offset = self._file.tell()
+        self._file.write(record)
+        self._file.flush()
+        # the index entry is written after its data
+        self._index.write(f"{company_key}\t{page}\t{offset}\t{len(record)}\n")
+        self._index.flush()
+        if on_persisted is not None:
+            on_persisted()
+
+    def _close_shard(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._index = None
+
+    def close(self):
+        self._close_shard()
+
+
+class ReviewWriter:
+    """One flat JSON line per review (see `scraper.review_records`).
+
+    Reviews are deduplicated by their id within a company (the same review
+    can show up on two pages of the company while the recency order
+    shifts). The ids are kept for the last `max_companies` companies
+    written, the companies in progress. Each session writes a new part
+    (`part-<nr>.jsonl.gz`); ids of existing parts are read at the start,
+    so resumed runs do not repeat reviews.
+    """
+
+    def __init__(self, path, max_companies=10_000):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_companies = max_companies
+        # company key -> review ids, least recently written first
+        self.review_ids = OrderedDict()
+        self.n_written = 0
+        self.n_duplicates = 0
+        part_nrs = []
+        for filename in sorted(self.path.iterdir()):
+            match = REVIEW_PART_PATTERN.match(filename.name)
+            if match:
+                part_nrs.append(int(match.group(1)))
+                for company_key, review_id in _read_review_ids(filename):
+                    self._company_review_ids(company_key).add(review_id)
+        part_nr = max(part_nrs, default=-1) + 1
+        self.filename = self.path / f"part-{part_nr:05d}.jsonl.gz"
+        self._file = gzip.open(self.filename, "wb")
+
+    def _company_review_ids(self, company_key):
+        review_ids = self.review_ids.get(company_key)
+        if review_ids is None:
+            review_ids = self.review_ids[company_key] = set()
+            if len(self.review_ids) > self.max_companies:
+                self.review_ids.popitem(last=False)
+        else:
+            self.review_ids.move_to_end(company_key)
+        return review_ids
+
+    def write(self, company_key, page, data, on_persisted=None):
+        lines = []
+        review_ids = self._company_review_ids(company_key)
+        for record in scraper.review_records(data["jsonld"], company_key):
+            review_id = record["id"]
+            if review_id is not None:
+                if review_id in review_ids:
+                    self.n_duplicates += 1
+                    continue
+                review_ids.add(review_id)
+            lines.append(json.dumps(record).encode("utf-8") + b"\n")
+        self._file.write(b"".join(lines))
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+        self.n_written += len(lines)
+        if on_persisted is not None:
+            on_persisted()
+
+    def close(self):
+        self._file.close()
+
+
+class MultiWriter:
+    """Writes each page with several writers (e.g. pages and reviews)."""
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, company_key, page, data, on_persisted=None):
+        for writer in self.writers[:-1]:
+            writer.write(company_key, page, data)
+        self.writers[-1].write(company_key, page, data, on_persisted)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class MeteredWriter:
+    """Records the time spent persisting each page (see metrics.Metrics)."""
+
+    def __init__(self, writer, metrics):
+        self.writer = writer
+        self.metrics = metrics
+
+    def write(self, company_key, page, data, on_persisted=None):
+        start = time.perf_counter()
+        self.writer.write(company_key, page, data, on_persisted)
+        self.metrics.observe("persist_seconds", time.perf_counter() - start)
+        self.metrics.inc("pages_persisted_total")
+
+    def close(self):
+        self.writer.close()
+
+
+class BackgroundWriter:
+    """Runs a writer in a background thread fed by a bounded queue.
+    Serialization, compression and IO do not block the caller (unless the
+    queue is full). Errors of the writer are raised by the next call.
+    """
+
+    def __init__(self, writer, maxsize=1000):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name="tp-harvester-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self.writer.write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, company_key, page, data, on_persisted=None):
+        self._raise_error()
+        self._queue.put((company_key, page, data, on_persisted))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close()
+        self._raise_error()
+
+
+def open_writer(
+    base_path,
+    name,
+    output_format="tar",
+    compression="gzip",
+    background=True,
+    part="",
+    extract_reviews=False,
+    metrics=None,
+):
+    """Writer for the harvest `name` (e.g. '<date>-<lang>-...-jsonld').
+    With `extract_reviews` the review records are written in addition
+    (`<name>-reviews/`). With `metrics` the persist time is recorded.
+    """
+    base_path = Path(base_path)
+    writers = []
+    if output_format == "tar":
+        writers.append(TarWriter(base_path / f"{name}{part}.tar.gz"))
+    elif output_format == "shards":
+        writers.append(ShardWriter(base_path / name, compression=compression))
+    elif output_format != "none":
+        raise ValueError(
+            f"Unknown output format {output_format}. Use one of {OUTPUT_FORMATS}"
+        )
+    if extract_reviews:
+        writers.append(ReviewWriter(base_path / f"{name}-reviews"))
+    if not writers:
+        raise ValueError("Nothing to write: no output format and no reviews.")
+    writer = writers[0] if len(writers) == 1 else MultiWriter(writers)
+    if metrics is not None:
+        writer = MeteredWriter(writer, metrics)
+    if background:
+        writer = BackgroundWriter(writer)
+    return writer
+
+
+def decode_record(record, compression="gzip"):
+    """Page data of one compressed record of a shard"""
+    if compression == "gzip":
+        return json.loads(gzip.decompress(record))
+    if zstandard is None:
+        raise ImportError("zstd compression needs the package zstandard")
+    return json.loads(zstandard.ZstdDecompressor().decompress(record))
+
+
+def _read_review_ids(filename):
+    """Yields `(company_key, review_id)` of a part (possibly truncated by
+    a killed run)"""
+    try:
+        with gzip.open(filename, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # incomplete last line
+                if record["id"] is not None:
+                    yield record["company_key"], record["id"]
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        pass
+
+
+def _compressor(compression):
+    if compression == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    compressor = zstandard.ZstdCompressor(level=3)
+    return compressor.compress
+
+
+def _add_data_to_tar(tar, data, filename):
+    data_raw = json.dumps(data)
+    data_raw_encoded = data_raw.encode("utf-8")
+    fileobj = io.BytesIO(data_raw_encoded)
+    tarinfo = tarfile.TarInfo(name=filename)
+    tarinfo.size = len(data_raw_encoded)
+    tar.addfile(tarinfo, fileobj)